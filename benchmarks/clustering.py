@@ -0,0 +1,67 @@
+"""
+Compare the grid clustering engine against the original DBSCAN engine.
+
+Generates Boston-area coordinates shaped like a year of Bluebikes data (dock locations
+plus e-bike GPS noise around them), checks that both engines produce identical
+`coordinate_group_id` labels at the given threshold, and reports how each scales in
+wall time (best of three) and peak traced memory. The default `auto` engine switches
+from DBSCAN to grid at GRID_ENGINE_MIN_POINTS, around where these timings cross.
+
+    uv run python benchmarks/clustering.py --sizes 2000 20000 100000 --dbscan-max 100000
+"""
+import argparse
+import time
+import tracemalloc
+from pathlib import Path
+import sys
+
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from src.coordinate_clustering import cluster_coordinates
+
+def synthetic_coordinates(point_count, station_count=600, gps_noise_share=0.6, seed=0):
+    rng = np.random.default_rng(seed)
+    stations = np.column_stack([42.35 + rng.normal(0, 0.035, station_count),
+                                -71.09 + rng.normal(0, 0.045, station_count)])
+    docked_count = int(point_count * (1 - gps_noise_share))
+    docked = stations[rng.integers(0, station_count, docked_count)]
+    # E-bikes report GPS fixes scattered tens of meters around the dock
+    noisy = stations[rng.integers(0, station_count, point_count - docked_count)]
+    noisy = noisy + rng.normal(0, 0.0003, noisy.shape)
+    coords = np.unique(np.round(np.vstack([docked, noisy]), 6), axis=0)
+    return coords[rng.permutation(len(coords))]
+
+def measure_engine(coords, distance_threshold_meters, engine, repeat=3):
+    # Timed without tracemalloc, which slows the grid engine's many small allocations
+    # far more than DBSCAN's few large ones; memory is measured in a separate run
+    seconds = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        labels = cluster_coordinates(coords, distance_threshold_meters, engine)
+        seconds = min(seconds, time.perf_counter() - started)
+    tracemalloc.start()
+    cluster_coordinates(coords, distance_threshold_meters, engine)
+    peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+    tracemalloc.stop()
+    return seconds, peak_mb, labels
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2_000, 20_000, 100_000, 300_000])
+    parser.add_argument('--distance', type=float, default=30.0, help="Clustering threshold in meters")
+    parser.add_argument('--dbscan-max', type=int, default=100_000,
+                        help="Skip DBSCAN (and the equivalence check) above this many points")
+    args = parser.parse_args()
+
+    print(f"{'points':>9} {'groups':>8} {'grid s':>8} {'grid MB':>8} {'dbscan s':>9} {'dbscan MB':>10}  labels")
+    for size in args.sizes:
+        coords = synthetic_coordinates(size)
+        grid_seconds, grid_mb, grid_labels = measure_engine(coords, args.distance, 'grid')
+        row = f"{len(coords):>9} {grid_labels.max() + 1:>8} {grid_seconds:>8.3f} {grid_mb:>8.1f}"
+        if len(coords) <= args.dbscan_max:
+            dbscan_seconds, dbscan_mb, dbscan_labels = measure_engine(coords, args.distance, 'dbscan')
+            equivalent = 'identical' if np.array_equal(grid_labels, dbscan_labels) else 'DIFFERENT'
+            print(f"{row} {dbscan_seconds:>9.3f} {dbscan_mb:>10.1f}  {equivalent}")
+        else:
+            print(f"{row} {'-':>9} {'-':>10}  not checked")
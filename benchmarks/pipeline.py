@@ -0,0 +1,257 @@
+"""
+Benchmark the wrangle -> process -> load -> render pipeline on synthetic Bluebikes data.
+
+Generates (or reuses) monthly trip CSVs, then times each stage the way the project runs
+it: loading and preprocessing the raw rides, turning the busiest day into events,
+grouping their coordinates, preparing the dashboard dataset, filtering every time
+window, and building the dashboard spec for every window with and without cached
+frames. Each stage reports wall time, peak RSS and rows per second. Results are written
+as JSON and, given a baseline from an earlier run, compared against it so a slower
+stage fails the run.
+
+    uv run python benchmarks/pipeline.py --days 366 --rides-per-day 12000 --output benchmarks/results/year.json
+    uv run python benchmarks/pipeline.py --days 366 --rides-per-day 12000 --baseline benchmarks/results/year.json
+"""
+import argparse
+import json
+import os
+import platform
+import runpy
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import wait
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+sys.path.append(str(Path(__file__).resolve().parent))
+from src.data_wrangler import (find_monthly_csv_files, find_top_busiest_days, get_rides_for_specific_date, load_monthly_data,
+                               preprocess_rides_data, remove_ride_outliers, save_dataframe_to_parquet)
+from src.data_processor import process_clean_to_events
+from src.data_loader import VisualizationDataset, filter_data_for_time_window, group_nearby_coordinates
+from src.frame_cache import frame_cache
+from src.instrumentation import current_rss_bytes
+from synthetic_data import write_synthetic_monthly_csvs
+
+DASHBOARD_PATH = Path(__file__).resolve().parent.parent / "dashboard.py"
+
+class PeakRssSampler:
+    """
+    Samples the process RSS on a background thread and keeps the largest value seen, or
+    None where RSS can't be read.
+    """
+
+    def __init__(self, interval_seconds=0.005):
+        self.interval_seconds = interval_seconds
+        self.peak_bytes = current_rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stop.wait(self.interval_seconds):
+            self._update_peak()
+
+    def _update_peak(self):
+        rss_bytes = current_rss_bytes()
+        if rss_bytes is not None:
+            self.peak_bytes = max(self.peak_bytes or 0, rss_bytes)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._update_peak()
+
+@contextmanager
+def measure(results, stage, rows=0):
+    """
+    Time the body as `stage`. `rows` is how many rows the stage works through, for its
+    throughput; when only the body knows, it sets `rows` on the yielded record instead.
+    """
+    record = {'rows': rows}
+    rss_before = current_rss_bytes()
+    with PeakRssSampler() as sampler:
+        started = time.perf_counter()
+        yield record
+        seconds = time.perf_counter() - started
+    rows = int(record.pop('rows'))
+    peak_rss_mb = round(sampler.peak_bytes / 2**20, 1) if sampler.peak_bytes is not None else None
+    rss_growth_mb = round((sampler.peak_bytes - rss_before) / 2**20, 1) if None not in (sampler.peak_bytes, rss_before) else None
+    results[stage] = {
+        'seconds': round(seconds, 4),
+        'rows': rows,
+        'rows_per_second': round(rows / seconds, 1) if seconds > 0 else None,
+        'peak_rss_mb': peak_rss_mb,
+        'rss_growth_mb': rss_growth_mb,
+        **record,
+    }
+    print(f"{stage:<30} {seconds:>9.3f}s {rows:>11,} rows " + (f"{peak_rss_mb:>9.1f} MB peak RSS" if peak_rss_mb is not None else "  (no RSS)"))
+
+def run_pipeline(raw_dir, work_dir, repeat_spec=1):
+    stages = {}
+    raw_bytes = sum(path.stat().st_size for path in find_monthly_csv_files(raw_dir))
+
+    with measure(stages, 'load_monthly_data') as record:
+        raw_rides = load_monthly_data(raw_dir)
+        record['rows'] = len(raw_rides)
+    stages['load_monthly_data']['csv_mb_per_second'] = round(raw_bytes / 2**20 / stages['load_monthly_data']['seconds'], 1)
+
+    with measure(stages, 'preprocess_rides_data', len(raw_rides)):
+        rides = preprocess_rides_data(raw_rides)
+    del raw_rides
+
+    rides = remove_ride_outliers(rides)
+    busiest_day = find_top_busiest_days(rides, 1).index[0].strftime('%Y-%m-%d')
+    clean_path = work_dir / "clean" / "bluebikes_busiest_day.parquet"
+    clean_path.parent.mkdir(parents=True, exist_ok=True)
+    save_dataframe_to_parquet(get_rides_for_specific_date(rides, busiest_day), clean_path)
+    del rides
+
+    # Grouping is timed on its own below, so events are built here without it
+    ungrouped_path = work_dir / "processed" / "bluebikes_events_ungrouped.parquet"
+    ungrouped_path.parent.mkdir(parents=True, exist_ok=True)
+    busiest_day_rides = len(pd.read_parquet(clean_path, columns=['ride_id']))
+    with measure(stages, 'process_clean_to_events', busiest_day_rides):
+        events = process_clean_to_events(clean_path, ungrouped_path, group_coordinates=False)
+
+    with measure(stages, 'group_nearby_coordinates', len(events)):
+        events = group_nearby_coordinates(events, 30.0)
+    unique_points = len(events[['lat', 'lng']].drop_duplicates())
+    group_count = events['coordinate_group_id'].nunique()
+    stages['group_nearby_coordinates'].update(unique_points=unique_points, coordinate_groups=int(group_count),
+                                              point_reduction=round(1 - group_count / unique_points, 4))
+    events_path = work_dir / "data" / "processed" / "bluebikes_events.parquet"
+    events_path.parent.mkdir(parents=True, exist_ok=True)
+    events.to_parquet(events_path, index=False, engine='pyarrow')
+
+    start_data = events[events.event_type == 'start']
+    end_data = events[events.event_type == 'end']
+    with measure(stages, 'prepare_visualization_dataset', len(events)):
+        dataset = VisualizationDataset(start_data, end_data)
+
+    bike_types = ['all'] + dataset.start_index.bike_types
+    with measure(stages, 'filter_data_for_time_window', len(events) * len(bike_types)):
+        for bike_type in bike_types:
+            for time_window in range(144):
+                filter_data_for_time_window(dataset.start_index, dataset.end_index, time_window, bike_type)
+
+    stages.update(measure_dashboard_spec(work_dir, dataset, repeat_spec))
+    return stages, {'busiest_day': busiest_day, 'busiest_day_rides': busiest_day_rides, 'events': len(events)}
+
+def measure_dashboard_spec(work_dir, dataset, repeat_spec):
+    """
+    Time a playback pass over every window: setting `time_window` (which updates the views
+    and the DeckGL pane) and building App.spec, first rendering each frame and then
+    serving them from the frame cache. Throughput is in frames.
+    """
+    stages = {}
+    # dashboard.py builds its app at import, from the events file relative to the working directory
+    previous_cwd = Path.cwd()
+    try:
+        os.chdir(work_dir)
+        dashboard = runpy.run_path(str(DASHBOARD_PATH))
+    finally:
+        os.chdir(previous_cwd)
+
+    app = dashboard['App'](dataset=dataset)
+    # Let the background warm-up settle so it doesn't compete with the timed renders
+    wait(app._warm_frame_cache())
+    frame_cache.clear()
+    with measure(stages, 'app_spec_render', 144):
+        for time_window in range(144):
+            app.time_window = time_window
+            app.spec()
+    with measure(stages, 'app_spec_cached', 144 * repeat_spec):
+        for _ in range(repeat_spec):
+            for time_window in range(144):
+                app.time_window = time_window
+                app.spec()
+    return stages
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Print each stage against the baseline and return the stages that regressed."""
+    if baseline.get('config') != results['config']:
+        print("warning: baseline was recorded with a different configuration "
+              f"({baseline.get('config')}), comparisons may not be meaningful")
+    regressions = []
+    print(f"\n{'stage':<30} {'baseline s':>10} {'current s':>10} {'ratio':>7} {'RSS ratio':>9}")
+    for stage, current in results['stages'].items():
+        previous = baseline.get('stages', {}).get(stage)
+        if previous is None:
+            print(f"{stage:<30} {'-':>10} {current['seconds']:>10.3f}  (new stage)")
+            continue
+        time_ratio = current['seconds'] / previous['seconds'] if previous['seconds'] else float('inf')
+        if current['peak_rss_mb'] is None or previous['peak_rss_mb'] is None:
+            # RSS wasn't available on one of the runs, so only time is compared
+            rss_ratio = None
+        else:
+            rss_ratio = current['peak_rss_mb'] / previous['peak_rss_mb'] if previous['peak_rss_mb'] else float('inf')
+        regressed = time_ratio > 1 + tolerance or (rss_ratio is not None and rss_ratio > 1 + tolerance)
+        rss_column = f"{rss_ratio:>9.2f}" if rss_ratio is not None else f"{'-':>9}"
+        print(f"{stage:<30} {previous['seconds']:>10.3f} {current['seconds']:>10.3f} {time_ratio:>7.2f} {rss_column}"
+              + ("  REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(stage)
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--data-dir', type=Path, help="Benchmark these monthly CSVs instead of generating synthetic ones")
+    parser.add_argument('--start-date', default='2024-01-01')
+    parser.add_argument('--days', type=int, default=31)
+    parser.add_argument('--rides-per-day', type=int, default=10_000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat-spec', type=int, default=5, help="Passes over all windows for the cached spec stage")
+    parser.add_argument('--output', type=Path, help="Write the results JSON here")
+    parser.add_argument('--baseline', type=Path, help="Compare against results JSON from an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Allowed slowdown or RSS growth per stage relative to the baseline (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='bluebikes-benchmark-') as work_dir:
+        work_dir = Path(work_dir)
+        if args.data_dir:
+            raw_dir = args.data_dir
+            config = {'data_dir': str(args.data_dir.resolve())}
+        else:
+            raw_dir = work_dir / "raw"
+            started = time.perf_counter()
+            _, ride_count = write_synthetic_monthly_csvs(raw_dir, args.start_date, args.days, args.rides_per_day, args.seed)
+            print(f"Generated {ride_count:,} synthetic rides in {time.perf_counter() - started:.1f}s\n")
+            config = {'start_date': args.start_date, 'days': args.days, 'rides_per_day': args.rides_per_day, 'seed': args.seed}
+        config['repeat_spec'] = args.repeat_spec
+
+        stages, summary = run_pipeline(raw_dir, work_dir, args.repeat_spec)
+
+    results = {
+        'config': config,
+        'summary': summary,
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+        },
+        'recorded_at': pd.Timestamp.now(tz='UTC').isoformat(),
+        'stages': stages,
+    }
+    if args.output:
+        args.output.parent.mkdir(parents=True, exist_ok=True)
+        args.output.write_text(json.dumps(results, indent=2))
+        print(f"\nResults written to {args.output}")
+
+    if args.baseline:
+        regressions = compare_with_baseline(results, json.loads(args.baseline.read_text()), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} stage(s) regressed beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
+        print(f"\nNo stage regressed beyond {args.tolerance:.0%}")
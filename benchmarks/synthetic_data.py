@@ -0,0 +1,117 @@
+"""
+Generate synthetic monthly Bluebikes trip CSVs for benchmarking, without network access.
+
+Files have the same name pattern and columns as the published monthly exports, so the
+wrangler reads them unchanged. Ride volume follows a seasonal and weekday cycle around
+`--rides-per-day`, start times cluster around the commute peaks, and e-bikes report GPS
+fixes scattered around the docks. The output is fully determined by `--seed`.
+
+    uv run python benchmarks/synthetic_data.py data/raw --start-date 2024-01-01 --days 366 --rides-per-day 12000
+"""
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+
+STATION_COUNT = 600
+ELECTRIC_BIKE_SHARE = 0.45
+OVERNIGHT_RIDE_SHARE = 0.005
+
+def synthetic_stations(rng, station_count=STATION_COUNT):
+    return np.column_stack([42.35 + rng.normal(0, 0.035, station_count),
+                            -71.09 + rng.normal(0, 0.045, station_count)]).round(8)
+
+def daily_ride_counts(days, rides_per_day, rng):
+    # Busier in summer than winter, a little quieter at weekends
+    seasonal = 1 - 0.45 * np.cos(2 * np.pi * (days.dayofyear.to_numpy() - 20) / 365.25)
+    weekday = np.where(days.dayofweek.to_numpy() >= 5, 0.85, 1.05)
+    return rng.poisson(rides_per_day * seasonal * weekday)
+
+def seconds_into_day(ride_count, rng):
+    # Morning and evening commute peaks on top of a broad daytime spread
+    peak = rng.choice(3, ride_count, p=[0.2, 0.3, 0.5])
+    hours = np.select([peak == 0, peak == 1],
+                      [rng.normal(8.25, 0.9, ride_count), rng.normal(17.5, 1.2, ride_count)],
+                      rng.normal(14, 4.5, ride_count))
+    return (np.mod(hours, 24) * 3600).astype('int64')
+
+def synthetic_rides(days, rides_per_day, stations, rng):
+    ride_counts = daily_ride_counts(days, rides_per_day, rng)
+    ride_count = int(ride_counts.sum())
+    day_starts = np.repeat(days.to_numpy().astype('datetime64[ms]'), ride_counts)
+    started_at = day_starts + (seconds_into_day(ride_count, rng) * 1000 + rng.integers(0, 1000, ride_count)).astype('timedelta64[ms]')
+    duration_ms = (rng.lognormal(np.log(720), 0.7, ride_count) * 1000).astype('int64')
+    overnight = rng.random(ride_count) < OVERNIGHT_RIDE_SHARE
+    duration_ms[overnight] = rng.integers(86_400_000, 3 * 86_400_000, overnight.sum())
+    ended_at = started_at + duration_ms.astype('timedelta64[ms]')
+
+    start_stations = rng.integers(0, len(stations), ride_count)
+    end_stations = rng.integers(0, len(stations), ride_count)
+    electric = rng.random(ride_count) < ELECTRIC_BIKE_SHARE
+    start_lat, start_lng = stations[start_stations, 0], stations[start_stations, 1]
+    end_lat, end_lng = stations[end_stations, 0], stations[end_stations, 1]
+    # E-bikes are located by GPS rather than by their dock
+    start_lat = np.where(electric, (start_lat + rng.normal(0, 0.0002, ride_count)).round(6), start_lat)
+    start_lng = np.where(electric, (start_lng + rng.normal(0, 0.0002, ride_count)).round(6), start_lng)
+    end_lat = np.where(electric, (end_lat + rng.normal(0, 0.0002, ride_count)).round(6), end_lat)
+    end_lng = np.where(electric, (end_lng + rng.normal(0, 0.0002, ride_count)).round(6), end_lng)
+    # Bikes that never came back have no end location
+    end_lat[overnight & (rng.random(ride_count) < 0.5)] = np.nan
+    end_lng[np.isnan(end_lat)] = np.nan
+
+    order = np.argsort(started_at, kind='stable')
+    station_names = np.array([f"Station {i}" for i in range(len(stations))])
+    station_ids = np.array([f"S{i:05d}" for i in range(len(stations))])
+    columns = {
+        'ride_id': np.char.upper(np.char.mod('%016x', rng.integers(0, 2**63, ride_count, dtype='int64'))),
+        'rideable_type': np.where(electric, 'electric_bike', 'classic_bike'),
+        'started_at': started_at,
+        'ended_at': ended_at,
+        'start_station_name': station_names[start_stations],
+        'start_station_id': station_ids[start_stations],
+        'end_station_name': station_names[end_stations],
+        'end_station_id': station_ids[end_stations],
+        'start_lat': start_lat,
+        'start_lng': start_lng,
+        'end_lat': end_lat,
+        'end_lng': end_lng,
+        'member_casual': np.where(rng.random(ride_count) < 0.75, 'member', 'casual'),
+    }
+    return pa.table({name: pa.array(values[order], from_pandas=True) for name, values in columns.items()})
+
+def write_synthetic_monthly_csvs(output_dir, start_date='2024-01-01', days=1, rides_per_day=10_000, seed=0):
+    """
+    Write one `YYYYMM-bluebikes-tripdata.csv` per calendar month in the range, generating
+    a month at a time so multi-year ranges never hold more than one month in memory.
+    Returns the CSV paths and the total ride count.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    stations = synthetic_stations(rng)
+    all_days = pd.date_range(start_date, periods=days, freq='D')
+
+    csv_paths = []
+    ride_count = 0
+    for month, month_days in all_days.to_series().groupby(all_days.to_period('M')):
+        rides = synthetic_rides(pd.DatetimeIndex(month_days), rides_per_day, stations, rng)
+        csv_path = output_dir / f"{month.strftime('%Y%m')}-bluebikes-tripdata.csv"
+        pa_csv.write_csv(rides, csv_path)
+        csv_paths.append(csv_path)
+        ride_count += rides.num_rows
+    return csv_paths, ride_count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('output_dir', type=Path)
+    parser.add_argument('--start-date', default='2024-01-01')
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--rides-per-day', type=int, default=10_000, help="Average rides per day before seasonality")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    csv_paths, ride_count = write_synthetic_monthly_csvs(args.output_dir, args.start_date, args.days, args.rides_per_day, args.seed)
+    print(f"Wrote {ride_count:,} rides to {len(csv_paths)} monthly CSV file(s) in {args.output_dir}")
@@ -2,7 +2,14 @@ import panel as pn
 import pandas as pd
 import param
 import numpy as np
-from src.data_loader import load_and_prepare_visualization_data, filter_data_for_time_window
+from src.data_loader import (load_shared_visualization_dataset, filter_data_for_time_window, read_event_window_stats,
+                             VisualizationDataset)
+from src.frame_cache import frame_cache
+from src.instrumentation import configure_from_environment, stage
+from src.playback import PlaybackScheduler
+
+# Set BLUEBIKES_TRACE=trace.json to record per-tick timings (written when the server exits)
+configure_from_environment()
 
 pn.extension('deckgl', design='bootstrap', theme='dark', template='bootstrap')
 
@@ -21,10 +28,18 @@ class App(pn.viewable.Viewer):
     time_window = param.Integer(default=0, bounds=(0, 143))
     speed = param.Integer(default=1, bounds=(1, 10), label="Animation Speed")
     play = param.Event(label='▷')
+    achieved_fps = param.Number(default=0.0, precedence=-1)
+    
+    # Send per-group counts for each window instead of raw events
+    aggregate_events = param.Boolean(default=True, precedence=-1)
+    # Send only the columns the layers read, as typed arrays that travel as binary buffers
+    binary_transport = param.Boolean(default=True, precedence=-1)
     
     # Hardcode the radius
     HEXAGON_RADIUS = 50
     
+    LAYER_COLUMN_DTYPES = {'group_lng': 'float32', 'group_lat': 'float32', 'count': 'uint32'}
+    
     # Global elevation scaling based on entire 24-hour dataset
     global_max_start_events = param.Integer(default=1, precedence=-1)
     global_max_end_events = param.Integer(default=1, precedence=-1)
@@ -38,12 +53,23 @@ class App(pn.viewable.Viewer):
         [251,106,74,255],[239,59,44,255],[203,24,29,255],[165,15,21,255]
     ]
     
-    def __init__(self, start_data, end_data, **params):
+    def __init__(self, start_data=None, end_data=None, dataset=None, **params):
         self.deck_gl = None
+        self._playing = False
+        self._playback_frame = None
         super().__init__(**params)
         
-        self.start_data = start_data
-        self.end_data = end_data
+        # The window index and group counts are built once per dataset, and the dataset
+        # itself is shared by every session that loads the same events file
+        if dataset is None:
+            dataset = VisualizationDataset(start_data, end_data)
+        self.dataset = dataset
+        self.start_data = dataset.start_data
+        self.end_data = dataset.end_data
+        self.start_index = dataset.start_index
+        self.end_index = dataset.end_index
+        self.start_counts = dataset.start_counts
+        self.end_counts = dataset.end_counts
         self.view_start = pd.DataFrame()
         self.view_end = pd.DataFrame()
         
@@ -53,57 +79,59 @@ class App(pn.viewable.Viewer):
         self._update_time_window_view()
         
         self.deck_gl = pn.pane.DeckGL(
-            self.spec,
+            self.spec(),
             sizing_mode='stretch_both',
             margin=0        )
         
-        self._playing = False
-        self._cb = pn.state.add_periodic_callback(
-            self._update_time_window, 1000//max(1, self.speed), start=False
+        # Frames are looked up on an executor thread and applied on the event loop, so a
+        # slow frame never holds up other sessions' callbacks
+        self._playback = PlaybackScheduler(
+            lambda time_window: self._frame(time_window, 'all'),
+            self._apply_playback_frame,
+            frame_count=144,
+            fps=max(1, self.speed)
         )
+        self._applying_playback_frame = False
+        # The playback task runs on the server's shared loop rather than as a session
+        # callback, so stop it when the viewer's session goes away. Outside a server there
+        # is no session, and registering would attach this app to every future one.
+        if pn.state.curdoc is not None:
+            pn.state.on_session_destroyed(lambda session_context: self._playback.stop())
+
+        self._warm_frame_cache()
 
     def _calculate_global_elevation_scale(self):
         """
         Calculate the maximum number of events per coordinate group across all time windows.
         This ensures hexagon elevations are relative to the entire 24-hour dataset.
         """
-        if len(self.start_data) == 0 or len(self.end_data) == 0:
+        if self.dataset.is_empty:
             return
-            
-        # For start events: group by coordinate group and time window, count events
-        start_grouped = (self.start_data.groupby(['coordinate_group_id', 'time_window'])
-                        .size()
-                        .reset_index(name='event_count'))
         
-        # For end events: group by coordinate group and time window, count events  
-        end_grouped = (self.end_data.groupby(['coordinate_group_id', 'time_window'])
-                      .size()
-                      .reset_index(name='event_count'))
-        
-        # Find the maximum events per coordinate group in any single time window
-        self.global_max_start_events = start_grouped['event_count'].max() if len(start_grouped) > 0 else 1
-        self.global_max_end_events = end_grouped['event_count'].max() if len(end_grouped) > 0 else 1
+        # Maximum events in one coordinate group in any single time window, read from the
+        # precomputed counts rather than regrouping the events for every session
+        self.global_max_start_events = self.start_counts.max_group_count() or 1
+        self.global_max_end_events = self.end_counts.max_group_count() or 1
         
         print(f"Global elevation scaling calculated:")
         print(f"  Max start events per coordinate group: {self.global_max_start_events}")
         print(f"  Max end events per coordinate group: {self.global_max_end_events}")
 
-    @property
-    def start_hex_layer(self):
-        data = self.view_start
-        
-        if len(data) > 0:
+    def _hex_layer(self, layer_id, data, global_max_events, color_range):
+        if len(data) > 0 and self.aggregate_events:
+            local_max = data['count'].max()
+        elif len(data) > 0:
             local_max = data.groupby('coordinate_group_id').size().max()
         else:
             local_max = 1
 
-        scale_factor = (local_max / self.global_max_start_events) if self.global_max_start_events else 1
+        scale_factor = (local_max / global_max_events) if global_max_events else 1
         elevation_scale = 20 * scale_factor
 
-        return {
+        layer = {
             "@@type": "HexagonLayer",
-            "id": "start-hexagon-layer",
-            "data": data if len(data) > 0 else [],
+            "id": layer_id,
+            "data": self._project_layer_data(data) if len(data) > 0 else [],
             "pickable": False,
             "coverage": 1,
             "elevationRange": [0, 100],
@@ -111,34 +139,43 @@ class App(pn.viewable.Viewer):
             "radius": self.HEXAGON_RADIUS,
             "extruded": True,
             "getPosition": "@@=[group_lng, group_lat]",
-            "colorRange": self.GREEN_COLOR_RANGE
+            "colorRange": color_range
         }
+        if self.aggregate_events:
+            # Each point is a coordinate group carrying its event count for the window
+            layer.update({
+                "getElevationWeight": "@@=count",
+                "elevationAggregation": "SUM",
+                "getColorWeight": "@@=count",
+                "colorAggregation": "SUM",
+            })
+        return layer
+
+    def _project_layer_data(self, data):
+        """
+        Keep only the columns the hexagon layers access, as float32/uint32 arrays.
+        Panel sends DataFrame layer data as a ColumnDataSource, whose numeric columns are
+        transferred as binary buffers, while strings and timestamps would go as JSON lists.
+        """
+        if not self.binary_transport:
+            return data
+        columns = ['group_lng', 'group_lat'] + (['count'] if self.aggregate_events else [])
+        return pd.DataFrame({
+            column: data[column].to_numpy(dtype=self.LAYER_COLUMN_DTYPES[column]) for column in columns
+        })
 
     @property
-    def end_hex_layer(self):
-        data = self.view_end
+    def start_hex_layer(self):
+        return self._hex_layer("start-hexagon-layer", self.view_start, self.global_max_start_events, self.GREEN_COLOR_RANGE)
 
-        if len(data) > 0:
-            local_max = data.groupby('coordinate_group_id').size().max()
-        else:
-            local_max = 1
+    @property
+    def end_hex_layer(self):
+        return self._hex_layer("end-hexagon-layer", self.view_end, self.global_max_end_events, self.RED_COLOR_RANGE)
 
-        scale_factor = (local_max / self.global_max_end_events) if self.global_max_end_events else 1
-        elevation_scale = 20 * scale_factor
-
-        return {
-            "@@type": "HexagonLayer",
-            "id": "end-hexagon-layer",
-            "data": data if len(data) > 0 else [],
-            "pickable": False,
-            "coverage": 1,
-            "elevationRange": [0, 100],
-            "elevationScale": elevation_scale,
-            "radius": self.HEXAGON_RADIUS,
-            "extruded": True,
-            "getPosition": "@@=[group_lng, group_lat]",
-            "colorRange": self.RED_COLOR_RANGE
-        }
+    def _event_count(self, view):
+        if view is None or len(view) == 0:
+            return 0
+        return int(view['count'].sum()) if self.aggregate_events else len(view)
 
     def format_time(self, value):
         """Helper to turn time_window index into H:MM AM/PM"""
@@ -148,7 +185,52 @@ class App(pn.viewable.Viewer):
         hours_12 = hours_24 % 12 or 12
         return f"{hours_12}:{minutes:02d} {period}"
         
-    @param.depends('view_start', 'view_end', 'time_window')
+    def _window_views(self, time_window, bike_type='all'):
+        if self.aggregate_events:
+            return (self.start_counts.window_points(time_window, bike_type),
+                    self.end_counts.window_points(time_window, bike_type))
+        return filter_data_for_time_window(self.start_index, self.end_index, time_window, bike_type)
+
+    def _render_frame(self, time_window, bike_type='all'):
+        # Aggregated views come from the group counts, raw views from filtering the events
+        view_stage = 'dashboard.aggregate' if self.aggregate_events else 'dashboard.filter'
+        with stage(view_stage, time_window=time_window, bike_type=bike_type) as record:
+            view_start, view_end = self._window_views(time_window, bike_type)
+            record.rows_out = len(view_start) + len(view_end)
+        with stage('dashboard.layers', time_window=time_window, bike_type=bike_type):
+            layers = [
+                self._hex_layer("start-hexagon-layer", view_start, self.global_max_start_events, self.GREEN_COLOR_RANGE),
+                self._hex_layer("end-hexagon-layer", view_end, self.global_max_end_events, self.RED_COLOR_RANGE),
+            ]
+        return {
+            "view_start": view_start,
+            "view_end": view_end,
+            "layers": layers,
+        }
+
+    def _frame_key(self, time_window, bike_type='all'):
+        # Everything a rendered frame depends on, so sessions with the same settings share frames
+        return (self.dataset.cache_token, self.aggregate_events, self.binary_transport,
+                self.HEXAGON_RADIUS, bike_type, time_window)
+
+    def _frame(self, time_window, bike_type='all'):
+        return frame_cache.get(self._frame_key(time_window, bike_type),
+                               lambda: self._render_frame(time_window, bike_type))
+
+    def _warm_frame_cache(self):
+        """
+        Prerender every window for every bike type variant on the cache's background
+        threads, starting with the windows playback reaches first. Returns the futures of
+        the frames still to render.
+        """
+        windows = [(self.time_window + offset) % 144 for offset in range(144)]
+        bike_types = ['all'] + self.start_counts.bike_types
+        return frame_cache.warm(
+            [self._frame_key(time_window, bike_type) for bike_type in bike_types for time_window in windows],
+            lambda key: self._render_frame(key[-1], key[-2])
+        )
+
+    @param.depends('time_window')
     def spec(self):
         return {
             "initialViewState": {
@@ -160,37 +242,64 @@ class App(pn.viewable.Viewer):
                 "pitch": 40.5,
                 "zoom": 13.5
             },            "mapStyle": "https://basemaps.cartocdn.com/gl/dark-matter-gl-style/style.json",
-            "layers": [self.start_hex_layer, self.end_hex_layer],
+            # Prerendered layers for this window, so a tick only swaps in a cached frame
+            "layers": self._current_frame()["layers"],
             "views": [
                 {"@@type": "MapView", "controller": True}
             ]
         }
 
-    def _update_time_window(self):
-        self.time_window = (self.time_window + 1) % 144
+    def _current_frame(self):
+        # The frame playback prepared for this window, so it isn't looked up (or, if it was
+        # evicted from the cache meanwhile, rendered) a second time on the event loop
+        if self._playback_frame is not None and self._playback_frame[0] == self.time_window:
+            return self._playback_frame[1]
+        return self._frame(self.time_window, 'all')  # Always use 'all'
+
+    def _apply_playback_frame(self, time_window, frame):
+        self._applying_playback_frame = True
+        self._playback_frame = (time_window, frame)
+        try:
+            # Dispatch the change to the session's browser from outside a document callback
+            with pn.io.unlocked():
+                self.param.update(time_window=time_window, achieved_fps=round(self._playback.achieved_fps, 1))
+        finally:
+            self._applying_playback_frame = False
+            self._playback_frame = None
+
+    @param.depends('time_window', watch=True)
+    def _seek_playback(self):
+        # Moving the slider while playing continues playback from the new window
+        if self._playing and not self._applying_playback_frame:
+            self._playback.seek(self.time_window)
 
     @param.depends('time_window', watch=True)
     def _update_time_window_view(self):
-        if len(self.start_data) == 0 or len(self.end_data) == 0:
+        if self.dataset.is_empty:
             return
-            
-        self.view_start, self.view_end = filter_data_for_time_window(
-            self.start_data, self.end_data, self.time_window, 'all'  # Always use 'all'
-        )
+        
+        with stage('dashboard.tick', time_window=self.time_window, playing=self._playing):
+            frame = self._current_frame()
+            self.param.update(view_start=frame["view_start"], view_end=frame["view_end"])
+            # Pushing the spec converts the layers into the pane's Bokeh models
+            if self.deck_gl is not None:
+                with stage('dashboard.serialize', time_window=self.time_window):
+                    self.deck_gl.object = self.spec()
 
     @param.depends('speed', watch=True)
     def _update_speed(self):
-        if self._cb and self.speed > 0:
-            self._cb.period = 1000//max(1, self.speed)
+        if self.speed > 0:
+            self._playback.fps = max(1, self.speed)
 
     @param.depends('play', watch=True)
     def _play_pause(self):
         if self._playing:
-            self._cb.stop()
+            self._playback.stop()
+            self.achieved_fps = 0.0
             self.param.play.label = '⏵'
             # Removed speed precedence change
         else:
-            self._cb.start()
+            self._playback.start(self.time_window)
             self.param.play.label = '⏸'
             # Removed speed precedence change
         self._playing = not self._playing
@@ -221,17 +330,23 @@ class App(pn.viewable.Viewer):
         total_events_display = pn.widgets.StaticText(name='Total Events', value="0")
         start_events_display = pn.widgets.StaticText(name='Pickups', value="0")
         end_events_display = pn.widgets.StaticText(name='Dropoffs', value="0")
+        fps_display = pn.widgets.StaticText(name='Frames/s', value="0.0")
         
         @pn.depends(time_window=self.param.time_window)
         def update_time_display(time_window):
             time_display.value = time_range_formatter(time_window)
-            start_count = len(self.view_start) if self.view_start is not None else 0
-            end_count = len(self.view_end) if self.view_end is not None else 0
+            start_count = self._event_count(self.view_start)
+            end_count = self._event_count(self.view_end)
             total_events_display.value = str(start_count + end_count)
             start_events_display.value = str(start_count)
             end_events_display.value = str(end_count)
             return ""
         
+        @pn.depends(achieved_fps=self.param.achieved_fps)
+        def update_fps_display(achieved_fps):
+            fps_display.value = f"{achieved_fps:.1f}"
+            return ""
+        
         controls = pn.Column(
             pn.pane.Markdown("### About This Visualization", margin=(0,0,10,0)),
             pn.pane.Markdown("""
@@ -281,6 +396,8 @@ class App(pn.viewable.Viewer):
                 align='center',
                 margin=(10,0,0,0)
             ),
+            pn.Row(fps_display),
+            update_fps_display,
             margin=(20,10),
             css_classes=['control-panel'],
             height=800,
@@ -302,13 +419,19 @@ class App(pn.viewable.Viewer):
         )
 
 try:
-    full_data, start_data, end_data = load_and_prepare_visualization_data(
-        'data/processed/bluebikes_events.parquet',
+    events_path = 'data/processed/bluebikes_events.parquet'
+    dataset = load_shared_visualization_dataset(
+        events_path,
         group_coordinates=True,
-        distance_threshold_meters=30.0
+        distance_threshold_meters=30.0,
+        compact_schema=True,
+        # Files written with --window-row-groups are read a window at a time instead of up front
+        lazy=read_event_window_stats(events_path) is not None,
+        # Counted from the activity cube instead when data_processor.py ran with --activity-cube
+        activity_cube=True
     )
     
-    app = App(start_data=start_data, end_data=end_data)
+    app = App(dataset=dataset)
     
     app.controls.servable(area='sidebar')
     app.deck_gl.servable(title='Blue Bikes Buisiest Day of 2024 in Boston')
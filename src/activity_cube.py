@@ -0,0 +1,296 @@
+"""
+Event counts per (day, time_window, coordinate_group_id, event_type, bike_type), computed
+once from the events Parquet and stored next to it, so the dashboard, reports and
+notebooks answer count questions without rescanning events.
+
+The cube is a directory of .npy arrays, memory-mapped on open, plus a JSON sidecar:
+
+- the non-zero cells, sorted by (day, time_window) with an offset array into them, so
+  one day and window is a contiguous slice;
+- cumulative per-day totals per (event_type, bike_type, group), so any day range sums
+  to a difference of two rows;
+- each group's coordinates.
+
+A dense array over all five axes would be mostly zeros: a year of e-bike GPS groups
+runs to gigabytes, while the non-zero cells stay within the event count.
+"""
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+from src.instrumentation import instrumented
+
+ACTIVITY_CUBE_SUFFIX = '.activity'
+ACTIVITY_CUBE_VERSION = 1
+EVENT_TYPES = ['start', 'end']
+WINDOWS_PER_DAY = 144
+CUBE_SOURCE_COLUMNS = ['event_time', 'event_type', 'bike_type', 'time_window', 'coordinate_group_id', 'group_lat', 'group_lng']
+
+# Cells are accumulated under one int64 key: day, window, event type, bike type, then group
+_GROUP_BITS = 32
+_BIKE_TYPE_STRIDE = 256
+
+def activity_cube_path(events_parquet_path):
+    # Named after the whole file name, so bluebikes_events.parquet and the bluebikes_events/ dataset
+    # next to it get separate cubes: bluebikes_events.parquet.activity/ and bluebikes_events.activity/
+    events_parquet_path = Path(events_parquet_path)
+    return events_parquet_path.with_name(events_parquet_path.name + ACTIVITY_CUBE_SUFFIX)
+
+def _source_fingerprint(events_parquet_path):
+    events_parquet_path = Path(events_parquet_path)
+    files = sorted(events_parquet_path.rglob('*.parquet')) if events_parquet_path.is_dir() else [events_parquet_path]
+    stats = [f.stat() for f in files]
+    return {'files': len(stats), 'bytes': sum(s.st_size for s in stats), 'mtime_ns': max((s.st_mtime_ns for s in stats), default=0)}
+
+def _cell_keys(events, bike_type_codes):
+    days = events['event_time'].to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').astype('int64')
+    event_types = pd.Categorical(events['event_type'], categories=EVENT_TYPES).codes.astype('int64')
+    if (event_types < 0).any():
+        raise ValueError(f"Unknown event types: {sorted(set(events['event_type'].astype(str)) - set(EVENT_TYPES))}")
+    # Bike types are coded in the order they are first seen across batches
+    batch_codes, batch_bike_types = pd.factorize(events['bike_type'].astype(str))
+    bike_types = np.array([bike_type_codes.setdefault(bike_type, len(bike_type_codes)) for bike_type in batch_bike_types],
+                          dtype='int64')[batch_codes]
+    key = (days * WINDOWS_PER_DAY + events['time_window'].to_numpy().astype('int64')) * len(EVENT_TYPES) + event_types
+    key = key * _BIKE_TYPE_STRIDE + bike_types
+    return (key << _GROUP_BITS) | events['coordinate_group_id'].to_numpy().astype('int64')
+
+def _merge_cells(keys, counts):
+    unique_keys, inverse = np.unique(keys, return_inverse=True)
+    return unique_keys, np.bincount(inverse, weights=counts, minlength=len(unique_keys)).astype('int64')
+
+@instrumented()
+def build_activity_cube(events_parquet_path, cube_dir=None, batch_size=1_000_000):
+    """
+    Count the events at `events_parquet_path` (a file or a partitioned dataset with grouped
+    coordinates) a batch at a time and write the cube to `cube_dir`, by default
+    activity_cube_path(events_parquet_path). Returns the opened ActivityCube.
+    """
+    cube_dir = Path(cube_dir) if cube_dir is not None else activity_cube_path(events_parquet_path)
+    dataset = ds.dataset(events_parquet_path, format='parquet', partitioning='hive')
+    missing_columns = [col for col in CUBE_SOURCE_COLUMNS if col not in dataset.schema.names]
+    if missing_columns:
+        raise ValueError(f"Missing required columns: {missing_columns}")
+
+    bike_type_codes = {}
+    cell_keys = np.empty(0, dtype='int64')
+    cell_counts = np.empty(0, dtype='int64')
+    group_lat = np.empty(0)
+    group_lng = np.empty(0)
+    coordinate_dtype = None
+    for batch in dataset.to_batches(columns=CUBE_SOURCE_COLUMNS, batch_size=batch_size):
+        if batch.num_rows == 0:
+            continue
+        events = batch.to_pandas()
+        batch_keys, batch_counts = np.unique(_cell_keys(events, bike_type_codes), return_counts=True)
+        cell_keys, cell_counts = _merge_cells(np.concatenate([cell_keys, batch_keys]), np.concatenate([cell_counts, batch_counts]))
+
+        group_ids = events['coordinate_group_id'].to_numpy()
+        if group_ids.max() >= len(group_lat):
+            group_lat = np.concatenate([group_lat, np.full(group_ids.max() + 1 - len(group_lat), np.nan)])
+            group_lng = np.concatenate([group_lng, np.full(group_ids.max() + 1 - len(group_lng), np.nan)])
+        group_lat[group_ids] = events['group_lat'].to_numpy()
+        group_lng[group_ids] = events['group_lng'].to_numpy()
+        coordinate_dtype = events['group_lat'].dtype
+
+    # Decode the keys back into their axes
+    groups = (cell_keys & (2**_GROUP_BITS - 1)).astype('int32')
+    key = cell_keys >> _GROUP_BITS
+    # Renumber bike types in sorted order, as WindowGroupCounts lists them
+    bike_type_names = sorted(bike_type_codes)
+    sorted_codes = np.array([bike_type_names.index(bike_type) for bike_type in bike_type_codes], dtype='uint8')
+    bike_types = sorted_codes[key % _BIKE_TYPE_STRIDE]
+    key //= _BIKE_TYPE_STRIDE
+    event_types = (key % len(EVENT_TYPES)).astype('uint8')
+    key //= len(EVENT_TYPES)
+    epoch_days, time_windows = np.divmod(key, WINDOWS_PER_DAY)
+
+    first_day = int(epoch_days.min()) if len(cell_keys) else 0
+    day_count = int(epoch_days.max()) - first_day + 1 if len(cell_keys) else 0
+    day_indexes = epoch_days - first_day
+    group_count = len(group_lat)
+    bike_type_count = len(bike_type_names)
+
+    # Cells are sorted by key, so by (day, window); offsets mark where each (day, window) starts
+    offsets = np.searchsorted(day_indexes * WINDOWS_PER_DAY + time_windows, np.arange(day_count * WINDOWS_PER_DAY + 1))
+    daily_totals = np.zeros((day_count, len(EVENT_TYPES), bike_type_count, group_count), dtype='uint32')
+    np.add.at(daily_totals, (day_indexes, event_types, bike_types, groups), cell_counts.astype('uint32'))
+    daily_cumulative = np.concatenate([np.zeros((1,) + daily_totals.shape[1:], dtype='uint32'),
+                                       np.cumsum(daily_totals, axis=0, dtype='uint32')])
+
+    # Write into a fresh directory and swap it in, so readers never see half a cube
+    temp_dir = cube_dir.with_name(f"{cube_dir.name}.{os.getpid()}.tmp")
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    temp_dir.mkdir(parents=True)
+    arrays = {
+        'cell_offsets': offsets.astype('int64'),
+        'cell_groups': groups,
+        'cell_event_types': event_types,
+        'cell_bike_types': bike_types,
+        'cell_counts': cell_counts.astype('uint32'),
+        'daily_cumulative': daily_cumulative,
+        'group_coordinates': np.column_stack([group_lat, group_lng]).astype(coordinate_dtype or 'float64'),
+    }
+    for name, array in arrays.items():
+        np.save(temp_dir / f"{name}.npy", array)
+    (temp_dir / 'cube.json').write_text(json.dumps({
+        'version': ACTIVITY_CUBE_VERSION,
+        'first_day': str(np.datetime64(first_day, 'D')),
+        'day_count': day_count,
+        'windows_per_day': WINDOWS_PER_DAY,
+        'event_types': EVENT_TYPES,
+        'bike_types': bike_type_names,
+        'group_count': group_count,
+        'source': _source_fingerprint(events_parquet_path),
+    }, indent=2))
+    shutil.rmtree(cube_dir, ignore_errors=True)
+    os.replace(temp_dir, cube_dir)
+    return ActivityCube(cube_dir)
+
+def load_activity_cube(events_parquet_path, cube_dir=None):
+    """The cube built from `events_parquet_path`, or None when it is missing or older than the events."""
+    cube_dir = Path(cube_dir) if cube_dir is not None else activity_cube_path(events_parquet_path)
+    sidecar_path = cube_dir / 'cube.json'
+    if not sidecar_path.exists():
+        return None
+    sidecar = json.loads(sidecar_path.read_text())
+    if sidecar.get('version') != ACTIVITY_CUBE_VERSION or sidecar.get('source') != _source_fingerprint(events_parquet_path):
+        return None
+    return ActivityCube(cube_dir)
+
+class ActivityCube:
+    """
+    Read-only, memory-mapped view of a cube written by build_activity_cube.
+
+    Days are given as anything pd.Timestamp accepts and ranges include both ends.
+    `event_type` and `bike_type` select one value or, left as None, sum over all of them.
+    Counts come back as arrays indexed by coordinate_group_id.
+    """
+
+    def __init__(self, cube_dir):
+        self.cube_dir = Path(cube_dir)
+        sidecar = json.loads((self.cube_dir / 'cube.json').read_text())
+        self.first_day = pd.Timestamp(sidecar['first_day'])
+        self.day_count = sidecar['day_count']
+        self.event_types = sidecar['event_types']
+        self.bike_types = sidecar['bike_types']
+        self.group_count = sidecar['group_count']
+
+        def load(name):
+            return np.load(self.cube_dir / f"{name}.npy", mmap_mode='r')
+        self.cell_offsets = load('cell_offsets')
+        self.cell_groups = load('cell_groups')
+        self.cell_event_types = load('cell_event_types')
+        self.cell_bike_types = load('cell_bike_types')
+        self.cell_counts = load('cell_counts')
+        self.daily_cumulative = load('daily_cumulative')
+        group_coordinates = load('group_coordinates')
+        self.group_lat = group_coordinates[:, 0]
+        self.group_lng = group_coordinates[:, 1]
+
+    @property
+    def days(self):
+        return pd.date_range(self.first_day, periods=self.day_count, freq='D')
+
+    def day_index(self, day):
+        index = (pd.Timestamp(day).normalize() - self.first_day).days
+        if not 0 <= index < self.day_count:
+            raise KeyError(f"{pd.Timestamp(day).date()} is outside the cube ({self.days[0].date()} to {self.days[-1].date()})")
+        return index
+
+    def _day_range(self, start_day, end_day):
+        start_index = 0 if start_day is None else self.day_index(start_day)
+        end_index = self.day_count - 1 if end_day is None else self.day_index(end_day)
+        return start_index, end_index
+
+    def _selector(self, values, value):
+        # Position of one event or bike type, or None for all of them
+        if value is None:
+            return None
+        if value not in values:
+            raise KeyError(f"Unknown type {value!r}, expected one of {values}")
+        return values.index(value)
+
+    def _cell_range(self, start_index, end_index, time_window=None):
+        if time_window is None:
+            return self.cell_offsets[start_index * WINDOWS_PER_DAY], self.cell_offsets[(end_index + 1) * WINDOWS_PER_DAY]
+        bucket = start_index * WINDOWS_PER_DAY + time_window
+        return self.cell_offsets[bucket], self.cell_offsets[bucket + 1]
+
+    def _cell_mask(self, cells, event_type, bike_type):
+        event_type_index = self._selector(self.event_types, event_type)
+        bike_type_index = self._selector(self.bike_types, bike_type)
+        mask = np.ones(cells.stop - cells.start, dtype=bool)
+        if event_type_index is not None:
+            mask &= self.cell_event_types[cells] == event_type_index
+        if bike_type_index is not None:
+            mask &= self.cell_bike_types[cells] == bike_type_index
+        return mask
+
+    def window_counts(self, day, time_window, event_type=None, bike_type=None):
+        """Events per group in one day's time window."""
+        cells = slice(*self._cell_range(self.day_index(day), None, time_window))
+        mask = self._cell_mask(cells, event_type, bike_type)
+        return np.bincount(self.cell_groups[cells][mask], weights=self.cell_counts[cells][mask],
+                           minlength=self.group_count).astype('uint32')
+
+    def counts(self, start_day=None, end_day=None, event_type=None, bike_type=None):
+        """Dense (days, time_windows, groups) counts for a day range, by default every day."""
+        start_index, end_index = self._day_range(start_day, end_day)
+        first_cell, last_cell = self._cell_range(start_index, end_index)
+        cells = slice(first_cell, last_cell)
+        mask = self._cell_mask(cells, event_type, bike_type)
+        buckets = np.searchsorted(self.cell_offsets, np.arange(first_cell, last_cell)[mask], side='right') - 1
+        flat = (buckets - start_index * WINDOWS_PER_DAY) * self.group_count + self.cell_groups[cells][mask]
+        day_count = end_index - start_index + 1
+        return (np.bincount(flat, weights=self.cell_counts[cells][mask], minlength=day_count * WINDOWS_PER_DAY * self.group_count)
+                .astype('uint32')
+                .reshape(day_count, WINDOWS_PER_DAY, self.group_count))
+
+    def day_range_totals(self, start_day=None, end_day=None, event_type=None, bike_type=None):
+        """Events per group summed over a day range, from the cumulative daily totals."""
+        start_index, end_index = self._day_range(start_day, end_day)
+        totals = (self.daily_cumulative[end_index + 1].astype('int64') - self.daily_cumulative[start_index])
+        event_type_index = self._selector(self.event_types, event_type)
+        bike_type_index = self._selector(self.bike_types, bike_type)
+        totals = totals.sum(axis=0) if event_type_index is None else totals[event_type_index]
+        return totals.sum(axis=0) if bike_type_index is None else totals[bike_type_index]
+
+    def net_flow(self, start_day=None, end_day=None, bike_type=None):
+        """Starts minus ends per group over a day range: positive where bikes leave, negative where they pile up."""
+        return (self.day_range_totals(start_day, end_day, 'start', bike_type)
+                - self.day_range_totals(start_day, end_day, 'end', bike_type))
+
+    def top_groups(self, k=10, start_day=None, end_day=None, event_type=None, bike_type=None):
+        """The `k` busiest groups (stations) over a day range, busiest first."""
+        totals = self.day_range_totals(start_day, end_day, event_type, bike_type)
+        k = min(k, len(totals))
+        top = np.argpartition(-totals, k - 1)[:k] if k else np.empty(0, dtype='int64')
+        top = top[np.argsort(-totals[top], kind='stable')]
+        return pd.DataFrame({
+            'coordinate_group_id': top,
+            'group_lat': self.group_lat[top],
+            'group_lng': self.group_lng[top],
+            'count': totals[top],
+        })
+
+    def window_group_counts(self, event_type, start_day=None, end_day=None):
+        """
+        (bike_types, time_windows, groups) counts of one event type summed over a day range,
+        the layout of WindowGroupCounts.counts.
+        """
+        start_index, end_index = self._day_range(start_day, end_day)
+        first_cell, last_cell = self._cell_range(start_index, end_index)
+        cells = slice(first_cell, last_cell)
+        mask = self._cell_mask(cells, event_type, None)
+        buckets = np.searchsorted(self.cell_offsets, np.arange(first_cell, last_cell)[mask], side='right') - 1
+        flat = ((self.cell_bike_types[cells][mask].astype('int64') * WINDOWS_PER_DAY + buckets % WINDOWS_PER_DAY)
+                * self.group_count + self.cell_groups[cells][mask])
+        return (np.bincount(flat, weights=self.cell_counts[cells][mask],
+                            minlength=len(self.bike_types) * WINDOWS_PER_DAY * self.group_count)
+                .astype('uint32')
+                .reshape(len(self.bike_types), WINDOWS_PER_DAY, self.group_count))
@@ -0,0 +1,119 @@
+import numpy as np
+from sklearn.cluster import DBSCAN
+from sklearn.neighbors import BallTree
+from src.instrumentation import instrumented
+
+EARTH_RADIUS_METERS = 6371000
+
+def cluster_coordinates_dbscan(coords_rad, eps_radians):
+    dbscan = DBSCAN(eps=eps_radians, min_samples=1, metric='haversine')
+    return dbscan.fit_predict(coords_rad)
+
+def _grid_cells(coords_rad, eps_radians):
+    # Two points within eps never differ by more than eps in latitude, nor by more than
+    # eps in longitude once it is scaled by the smallest cos(lat) in the data, so every
+    # neighbor of a point lies in one of the 3x3 cells around it.
+    lng_scale = np.cos(np.abs(coords_rad[:, 0]).max())
+    cell_y = np.floor(coords_rad[:, 0] / eps_radians).astype('int64')
+    cell_x = np.floor(coords_rad[:, 1] * lng_scale / eps_radians).astype('int64')
+    return cell_x - cell_x.min(), cell_y - cell_y.min()
+
+def _iter_grid_neighbor_pairs(coords_rad, eps_radians, cells_per_tile):
+    cell_x, cell_y = _grid_cells(coords_rad, eps_radians)
+    tile_x = cell_x // cells_per_tile
+    tile_y = cell_y // cells_per_tile
+    # Pad by one tile on each side so neighbor tile keys never collide
+    tile_stride = tile_y.max() + 3
+    tile_keys = (tile_x + 1) * tile_stride + (tile_y + 1)
+
+    order = np.argsort(tile_keys, kind='stable')
+    sorted_keys = tile_keys[order]
+    unique_keys, tile_starts = np.unique(sorted_keys, return_index=True)
+    tile_ends = np.append(tile_starts[1:], len(sorted_keys))
+    neighbor_offsets = np.array([dx * tile_stride + dy for dx in (-1, 0, 1) for dy in (-1, 0, 1)])
+
+    for tile_key, tile_start, tile_end in zip(unique_keys, tile_starts, tile_ends):
+        core_points = order[tile_start:tile_end]
+        neighbor_keys = tile_key + neighbor_offsets
+        candidate_starts = np.searchsorted(sorted_keys, neighbor_keys, side='left')
+        candidate_ends = np.searchsorted(sorted_keys, neighbor_keys, side='right')
+        candidate_points = np.concatenate([order[a:b] for a, b in zip(candidate_starts, candidate_ends)])
+
+        # Only candidates in the cells bordering this tile can be within eps of it
+        core_x, core_y = cell_x[core_points], cell_y[core_points]
+        candidate_points = candidate_points[
+            (cell_x[candidate_points] >= core_x.min() - 1) & (cell_x[candidate_points] <= core_x.max() + 1)
+            & (cell_y[candidate_points] >= core_y.min() - 1) & (cell_y[candidate_points] <= core_y.max() + 1)
+        ]
+
+        tree = BallTree(coords_rad[candidate_points], metric='haversine')
+        neighborhoods = tree.query_radius(coords_rad[core_points], r=eps_radians)
+        neighbor_counts = np.fromiter((len(n) for n in neighborhoods), dtype='int64', count=len(neighborhoods))
+        sources = np.repeat(core_points, neighbor_counts)
+        targets = candidate_points[np.concatenate(neighborhoods)]
+        keep = sources < targets
+        yield sources[keep], targets[keep]
+
+def _find_roots(parent, points):
+    roots = parent[points]
+    while True:
+        next_roots = parent[roots]
+        if np.array_equal(next_roots, roots):
+            return roots
+        roots = next_roots
+
+def _union(parent, sources, targets):
+    # Hook every root under the smallest root it shares an edge with until each edge
+    # joins points with the same root
+    while len(sources):
+        source_roots, target_roots = _find_roots(parent, sources), _find_roots(parent, targets)
+        parent[sources], parent[targets] = source_roots, target_roots
+        unmerged = source_roots != target_roots
+        if not unmerged.any():
+            break
+        sources, targets = sources[unmerged], targets[unmerged]
+        source_roots, target_roots = source_roots[unmerged], target_roots[unmerged]
+        np.minimum.at(parent, np.maximum(source_roots, target_roots), np.minimum(source_roots, target_roots))
+
+def cluster_coordinates_grid(coords_rad, eps_radians, cells_per_tile=16):
+    """
+    Same clusters as DBSCAN(min_samples=1, metric='haversine'), which are the connected
+    components of the "within eps" graph, without a global neighbor search.
+
+    Points are bucketed into eps-sized grid cells and processed a tile of cells at a time:
+    each tile queries a BallTree built only from its own and bordering cells, and its
+    neighbor pairs are merged into a union-find forest before the next tile, so memory
+    is bounded by one tile's neighborhoods. Labels are numbered by each cluster's
+    smallest point index, the same order DBSCAN assigns them in.
+    """
+    point_count = len(coords_rad)
+    if point_count == 0:
+        return np.empty(0, dtype='int64')
+    parent = np.arange(point_count)
+    for sources, targets in _iter_grid_neighbor_pairs(coords_rad, eps_radians, cells_per_tile):
+        _union(parent, sources, targets)
+    return np.unique(_find_roots(parent, np.arange(point_count)), return_inverse=True)[1]
+
+# Below this many coordinates the grid engine's per-tile BallTrees cost more than one
+# global DBSCAN (the timings cross between 30k and 45k points in benchmarks/clustering.py),
+# so a single day's ~2k coordinates stay on DBSCAN
+GRID_ENGINE_MIN_POINTS = 40_000
+
+def cluster_coordinates_auto(coords_rad, eps_radians):
+    if len(coords_rad) < GRID_ENGINE_MIN_POINTS:
+        return cluster_coordinates_dbscan(coords_rad, eps_radians)
+    return cluster_coordinates_grid(coords_rad, eps_radians)
+
+CLUSTERING_ENGINES = {
+    'auto': cluster_coordinates_auto,
+    'dbscan': cluster_coordinates_dbscan,
+    'grid': cluster_coordinates_grid,
+}
+
+@instrumented()
+def cluster_coordinates(coords_deg, distance_threshold_meters=30.0, engine='auto'):
+    if engine not in CLUSTERING_ENGINES:
+        raise ValueError(f"Unknown clustering engine: {engine}")
+    coords_rad = np.radians(coords_deg)
+    eps_radians = distance_threshold_meters / EARTH_RADIUS_METERS
+    return CLUSTERING_ENGINES[engine](coords_rad, eps_radians)
@@ -0,0 +1,123 @@
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pathlib import Path
+from sklearn.neighbors import BallTree
+from src.coordinate_clustering import EARTH_RADIUS_METERS, cluster_coordinates
+
+# Coordinates are keyed at 1e-7 degrees (about 1 cm), which packs lat/lng into one int64
+COORDINATE_KEY_SCALE = 10_000_000
+_LNG_KEY_RANGE = 360 * COORDINATE_KEY_SCALE + 1
+
+INDEX_METADATA_KEY = b'coordinate_index'
+
+def coordinate_keys(lat, lng):
+    lat_key = np.round(np.asarray(lat, dtype='float64') * COORDINATE_KEY_SCALE).astype('int64') + 90 * COORDINATE_KEY_SCALE
+    lng_key = np.round(np.asarray(lng, dtype='float64') * COORDINATE_KEY_SCALE).astype('int64') + 180 * COORDINATE_KEY_SCALE
+    return lat_key * _LNG_KEY_RANGE + lng_key
+
+def empty_coordinate_index():
+    return pd.DataFrame({
+        'coordinate_key': pd.Series(dtype='int64'),
+        'lat': pd.Series(dtype='float64'),
+        'lng': pd.Series(dtype='float64'),
+        'coordinate_group_id': pd.Series(dtype='int64'),
+        'group_lat': pd.Series(dtype='float64'),
+        'group_lng': pd.Series(dtype='float64'),
+    })
+
+def load_coordinate_index(index_path, distance_threshold_meters=30.0):
+    index_path = Path(index_path)
+    if not index_path.exists():
+        return empty_coordinate_index()
+    table = pq.read_table(index_path)
+    metadata = json.loads((table.schema.metadata or {}).get(INDEX_METADATA_KEY, b'{}'))
+    # Groups built at another threshold are not reusable
+    if metadata.get('distance_threshold_meters') != distance_threshold_meters:
+        return empty_coordinate_index()
+    return table.to_pandas()
+
+def save_coordinate_index(coordinate_index, index_path, distance_threshold_meters=30.0):
+    index_path = Path(index_path)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    table = pa.Table.from_pandas(coordinate_index, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[INDEX_METADATA_KEY] = json.dumps({'distance_threshold_meters': distance_threshold_meters}).encode()
+    pq.write_table(table.replace_schema_metadata(metadata), index_path, compression='zstd')
+
+def update_coordinate_index(coordinate_index, lat, lng, distance_threshold_meters=30.0, engine='auto'):
+    """
+    Add any coordinates not yet in `coordinate_index` and return `(index, changed)`.
+
+    New coordinates are clustered among themselves first. A new cluster with any point
+    within the threshold of an indexed coordinate joins that coordinate's group (the
+    group of the closest such coordinate, if there are several), and the rest become new
+    groups, so existing group IDs never change. Existing groups also keep their
+    `group_lat`/`group_lng`, so events written on earlier runs still agree with the
+    index; a new group's centre is the mean of its coordinates. Built from an empty
+    index, the groups are exactly those of cluster_coordinates.
+    """
+    keys = coordinate_keys(lat, lng)
+    _, first_positions = np.unique(keys, return_index=True)
+    # Keep first-seen order so labels match clustering the coordinates directly
+    first_positions = np.sort(first_positions)
+    new_positions = first_positions[~np.isin(keys[first_positions], coordinate_index['coordinate_key'].to_numpy())]
+    if len(new_positions) == 0:
+        return coordinate_index, False
+
+    new_lat = np.asarray(lat, dtype='float64')[new_positions]
+    new_lng = np.asarray(lng, dtype='float64')[new_positions]
+    new_coords = np.column_stack([new_lat, new_lng])
+    new_labels = cluster_coordinates(new_coords, distance_threshold_meters, engine)
+
+    if len(coordinate_index):
+        existing_coords_rad = np.radians(coordinate_index[['lat', 'lng']].to_numpy())
+        distances, nearest = BallTree(existing_coords_rad, metric='haversine').query(np.radians(new_coords), k=1)
+        near_existing = distances[:, 0] <= distance_threshold_meters / EARTH_RADIUS_METERS
+        nearest_groups = coordinate_index['coordinate_group_id'].to_numpy()[nearest[:, 0]]
+
+        # Each cluster joins the group of the indexed coordinate closest to any of its
+        # points, the smallest group ID on a tie
+        candidates = np.flatnonzero(near_existing)
+        candidates = candidates[np.lexsort((nearest_groups[candidates], distances[candidates, 0], new_labels[candidates]))]
+        candidate_labels = new_labels[candidates]
+        first_per_label = np.ones(len(candidates), dtype=bool)
+        first_per_label[1:] = candidate_labels[1:] != candidate_labels[:-1]
+        label_groups = np.full(new_labels.max() + 1, -1, dtype='int64')
+        label_groups[candidate_labels[first_per_label]] = nearest_groups[candidates[first_per_label]]
+        unmatched_labels = np.flatnonzero(label_groups == -1)
+        label_groups[unmatched_labels] = coordinate_index['coordinate_group_id'].max() + 1 + np.arange(len(unmatched_labels))
+        new_group_ids = label_groups[new_labels]
+    else:
+        new_group_ids = new_labels.astype('int64')
+
+    new_entries = pd.DataFrame({
+        'coordinate_key': keys[new_positions],
+        'lat': new_lat,
+        'lng': new_lng,
+        'coordinate_group_id': new_group_ids,
+    })
+    # Existing groups keep their centres; only groups created here get one from their coordinates
+    existing_centers = coordinate_index.groupby('coordinate_group_id')[['group_lat', 'group_lng']].first()
+    new_centers = (new_entries[~new_entries['coordinate_group_id'].isin(existing_centers.index)]
+                   .groupby('coordinate_group_id')[['lat', 'lng']].mean()
+                   .rename(columns={'lat': 'group_lat', 'lng': 'group_lng'}))
+    group_centers = pd.concat([existing_centers, new_centers])
+    new_entries = new_entries.join(group_centers, on='coordinate_group_id')
+    if len(coordinate_index):
+        coordinate_index = pd.concat([coordinate_index, new_entries], ignore_index=True)
+    else:
+        coordinate_index = new_entries
+    return coordinate_index.sort_values('coordinate_key', ignore_index=True), True
+
+def assign_coordinate_groups(df, coordinate_index):
+    # Integer-key lookup into the index, which is kept sorted by coordinate_key
+    keys = coordinate_keys(df['lat'].to_numpy(), df['lng'].to_numpy())
+    positions = np.searchsorted(coordinate_index['coordinate_key'].to_numpy(), keys)
+    return df.reset_index(drop=True).assign(
+        group_lat=coordinate_index['group_lat'].to_numpy()[positions],
+        group_lng=coordinate_index['group_lng'].to_numpy()[positions],
+        coordinate_group_id=coordinate_index['coordinate_group_id'].to_numpy()[positions],
+    )
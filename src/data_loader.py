@@ -1,54 +1,511 @@
+import itertools
+import json
+import threading
 import pandas as pd
 import numpy as np
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from pathlib import Path
-from sklearn.cluster import DBSCAN
 from sklearn.preprocessing import StandardScaler
+from src.activity_cube import activity_cube_path, load_activity_cube
+from src.coordinate_index import (assign_coordinate_groups, empty_coordinate_index, load_coordinate_index,
+                                  save_coordinate_index, update_coordinate_index)
+from src.instrumentation import instrumented, stage
 
-def group_nearby_coordinates(df, distance_threshold_meters=30.0):
-    unique_coords = df[['lat', 'lng']].drop_duplicates().reset_index(drop=True)
-    coords_rad = np.radians(unique_coords[['lat', 'lng']].values)
-    earth_radius = 6371000
-    eps_radians = distance_threshold_meters / earth_radius
-    
-    dbscan = DBSCAN(eps=eps_radians, min_samples=1, metric='haversine')
-    cluster_labels = dbscan.fit_predict(coords_rad)
-    unique_coords['coordinate_group_id'] = cluster_labels
-    
-    grouped_coords = unique_coords.groupby('coordinate_group_id').agg({
-        'lat': 'mean',
-        'lng': 'mean'
-    }).reset_index()
-    grouped_coords.columns = ['coordinate_group_id', 'group_lat', 'group_lng']
-    
-    unique_coords = unique_coords.merge(grouped_coords, on='coordinate_group_id')
-    
-    result_df = df.merge(
-        unique_coords[['lat', 'lng', 'group_lat', 'group_lng', 'coordinate_group_id']], 
-        on=['lat', 'lng'], 
-        how='left'
-    )
-    
-    return result_df
+EVENT_TYPES = ['start', 'end']
+# The event columns the dashboard reads when loading lazily
+DASHBOARD_EVENT_COLUMNS = ['event_type', 'time_window', 'bike_type', 'coordinate_group_id', 'group_lat', 'group_lng']
+EVENT_WINDOW_STATS_KEY = b'event_window_stats'
+# Compact dtypes for event columns; ride_id and event_id are handled separately
+COMPACT_EVENT_DTYPES = {
+    'minute': 'int16',
+    'time_window': 'uint8',
+    'coordinate_group_id': 'int32',
+    'lat': 'float32',
+    'lng': 'float32',
+    'group_lat': 'float32',
+    'group_lng': 'float32',
+}
 
-def load_and_prepare_visualization_data(events_parquet_path, group_coordinates=True, distance_threshold_meters=30.0):
-    events_data = pd.read_parquet(events_parquet_path)
+# Value of each ASCII byte as an uppercase hex digit, 255 where it is not one
+_HEX_DIGIT_VALUES = np.full(256, 255, dtype='uint8')
+_HEX_DIGIT_VALUES[np.frombuffer(b'0123456789ABCDEF', dtype='uint8')] = np.arange(16)
+_HEX_DIGIT_SHIFTS = np.arange(60, -1, -4, dtype='uint64')
+
+def hex_ride_ids_to_uint64(ride_ids):
+    """
+    Pack ride IDs that are all 16 uppercase hex digits (the Bluebikes format) into uint64s,
+    which `f"{ride_id:016X}"` turns back into the original string. Returns None when
+    any ID does not have that form.
+    """
+    ride_ids = pd.Series(ride_ids)
+    if ride_ids.isna().any() or not (ride_ids.astype('string').str.len() == 16).all():
+        return None
+    digits = _HEX_DIGIT_VALUES[np.frombuffer(ride_ids.to_numpy(dtype='S16').tobytes(), dtype='uint8').reshape(-1, 16)]
+    if (digits == 255).any():
+        return None
+    return np.bitwise_or.reduce(digits.astype('uint64') << _HEX_DIGIT_SHIFTS, axis=1)
+
+def compact_event_columns(events):
+    """
+    Return `events` with compact dtypes: categoricals for event_type and bike_type, the
+    small integer and float32 types in COMPACT_EVENT_DTYPES, ride_id as uint64 when every
+    ID is hex (see hex_ride_ids_to_uint64) and event_id as uint32 when it fits.
+
+    float32 keeps coordinates to within about a meter, so compact events should be
+    written after coordinates are grouped, which needs full precision.
+    """
+    columns = {}
+    if 'event_type' in events.columns:
+        # Sorted like the bike_type categories, so pd.get_dummies(drop_first=True) drops the same
+        # column ('end') for compact events as for plain strings
+        columns['event_type'] = pd.Categorical(events['event_type'], categories=sorted(EVENT_TYPES))
+    if 'bike_type' in events.columns:
+        columns['bike_type'] = events['bike_type'].astype('category')
+    for column, dtype in COMPACT_EVENT_DTYPES.items():
+        if column in events.columns:
+            columns[column] = events[column].astype(dtype)
+    if 'ride_id' in events.columns and events['ride_id'].dtype != 'uint64':
+        ride_ids = hex_ride_ids_to_uint64(events['ride_id'])
+        if ride_ids is not None:
+            columns['ride_id'] = ride_ids
+    if 'event_id' in events.columns and len(events) and 0 <= events['event_id'].min() and events['event_id'].max() < 2**32:
+        columns['event_id'] = events['event_id'].astype('uint32')
+    return events.assign(**columns)
+
+@instrumented()
+def group_nearby_coordinates(df, distance_threshold_meters=30.0, engine='auto', coordinate_index_path=None):
+    """
+    Add `coordinate_group_id`, `group_lat` and `group_lng` for every row.
+
+    With `coordinate_index_path`, groups come from the persisted coordinate index and only
+    coordinates missing from it are clustered (and saved back), so groups stay stable
+    across days and runs. Otherwise the index is built in memory for this frame alone.
+    """
+    if coordinate_index_path is not None:
+        coordinate_index = load_coordinate_index(coordinate_index_path, distance_threshold_meters)
+    else:
+        coordinate_index = empty_coordinate_index()
+    with stage('data_loader.update_coordinate_index', rows_in=len(df), indexed_coordinates=len(coordinate_index)) as record:
+        coordinate_index, changed = update_coordinate_index(
+            coordinate_index, df['lat'].to_numpy(), df['lng'].to_numpy(), distance_threshold_meters, engine
+        )
+        record['indexed_coordinates_after'] = len(coordinate_index)
+    if coordinate_index_path is not None and changed:
+        save_coordinate_index(coordinate_index, coordinate_index_path, distance_threshold_meters)
+    with stage('data_loader.assign_coordinate_groups', rows_in=len(df)):
+        return assign_coordinate_groups(df, coordinate_index)
+
+def event_window_stats(events):
+    """
+    Per event type: the event count, the bike types, and the most events one coordinate
+    group has in one time window, overall and per bike type (the dashboard's elevation
+    scale). Stored in files written by save_events_by_time_window so a lazy reader gets
+    them without scanning the events.
+    """
+    stats = {}
+    for event_type in EVENT_TYPES:
+        typed_events = events[events['event_type'] == event_type]
+        bike_types = sorted(typed_events['bike_type'].dropna().unique().tolist())
+        stats[event_type] = {'events': len(typed_events), 'bike_types': bike_types}
+        if 'coordinate_group_id' in events.columns:
+            group_counts = typed_events.groupby(['bike_type', 'time_window', 'coordinate_group_id'], observed=True).size()
+            all_bike_counts = group_counts.groupby(level=['time_window', 'coordinate_group_id']).sum()
+            stats[event_type]['max_group_count'] = {
+                'all': int(all_bike_counts.max()) if len(all_bike_counts) else 0,
+                **{bike_type: int(group_counts.loc[bike_type].max()) for bike_type in bike_types},
+            }
+    return stats
+
+def read_event_window_stats(events_parquet_path):
+    # Only single files written by save_events_by_time_window carry the stats
+    events_parquet_path = Path(events_parquet_path)
+    if events_parquet_path.is_dir():
+        return None
+    metadata = pq.read_schema(events_parquet_path).metadata or {}
+    if EVENT_WINDOW_STATS_KEY not in metadata:
+        return None
+    return json.loads(metadata[EVENT_WINDOW_STATS_KEY])
+
+def _partition_names(dataset):
+    return set(dataset.partitioning.schema.names) if dataset.partitioning is not None else set()
+
+def _date_range_filter(dataset, start_date, end_date, time_column, partition_column=None):
+    range_start = pd.to_datetime(start_date).normalize()
+    range_end = pd.to_datetime(end_date).normalize() + pd.Timedelta(days=1)
+    partition_names = _partition_names(dataset)
+
+    range_filter = (ds.field(time_column) >= range_start) & (ds.field(time_column) < range_end)
+    if partition_column in partition_names:
+        range_filter &= ((ds.field(partition_column) >= range_start.strftime('%Y-%m-%d'))
+                         & (ds.field(partition_column) <= (range_end - pd.Timedelta(days=1)).strftime('%Y-%m-%d')))
+    if {'year', 'month'} <= partition_names:
+        month_filters = [(ds.field('year') == month.year) & (ds.field('month') == month.month)
+                         for month in pd.period_range(range_start, range_end - pd.Timedelta(days=1), freq='M')]
+        month_filter = month_filters[0]
+        for other_month_filter in month_filters[1:]:
+            month_filter |= other_month_filter
+        range_filter &= month_filter
+    return range_filter
+
+@instrumented()
+def read_parquet_for_date_range(parquet_path, start_date, end_date, time_column, partition_column=None):
+    """
+    Read only the rows whose `time_column` falls between `start_date` and `end_date`
+    (inclusive days) from a Parquet file or a Hive-partitioned dataset directory.
+    Day (`<partition_column>=YYYY-MM-DD`) and `year=/month=` partitions are pruned,
+    and the time range is pushed down to row groups.
+    """
+    dataset = ds.dataset(parquet_path, format='parquet', partitioning='hive')
+    partition_names = _partition_names(dataset)
+    range_filter = _date_range_filter(dataset, start_date, end_date, time_column, partition_column)
+
+    table = dataset.to_table(filter=range_filter)
+    table = table.drop_columns([name for name in ('year', 'month') if name in partition_names])
+    range_data = table.to_pandas()
+    if partition_column in partition_names:
+        range_data[partition_column] = pd.to_datetime(range_data[partition_column])
+    return range_data
+
+def read_parquet_for_date(parquet_path, date, time_column, partition_column=None):
+    return read_parquet_for_date_range(parquet_path, date, date, time_column, partition_column)
+
+@instrumented()
+def load_and_prepare_visualization_data(events_parquet_path, group_coordinates=True, distance_threshold_meters=30.0, date=None,
+                                        coordinate_index_path=None, compact_schema=False, lazy=False):
+    """
+    Returns `(events, start_events, end_events)`. With `lazy`, nothing is read yet: the
+    start and end events are LazyTimeWindowSources and `events` is None.
+    """
+    if lazy:
+        return None, LazyTimeWindowSource(events_parquet_path, 'start', date), LazyTimeWindowSource(events_parquet_path, 'end', date)
+    if date is not None:
+        events_data = read_parquet_for_date(events_parquet_path, date, 'event_time', 'event_date')
+    else:
+        events_data = pd.read_parquet(events_parquet_path)
     
     required_columns = ['event_type', 'minute', 'lat', 'lng', 'bike_type', 'time_window']
     missing_columns = [col for col in required_columns if col not in events_data.columns]
     if missing_columns:
         raise ValueError(f"Missing required columns: {missing_columns}")
     
-    processed_data = events_data.copy()
+    # events_data is freshly read and the boolean masks below already return new frames
+    processed_data = events_data
     
     if group_coordinates and 'group_lat' not in processed_data.columns:
-        processed_data = group_nearby_coordinates(processed_data, distance_threshold_meters)
+        processed_data = group_nearby_coordinates(processed_data, distance_threshold_meters, coordinate_index_path=coordinate_index_path)
+    
+    # Files written with the compact schema already have these types and are left as read
+    if compact_schema:
+        processed_data = compact_event_columns(processed_data)
     
-    start_data = processed_data[processed_data.event_type == 'start'].copy()
-    end_data = processed_data[processed_data.event_type == 'end'].copy()
+    start_data = processed_data[processed_data.event_type == 'start']
+    end_data = processed_data[processed_data.event_type == 'end']
     
     return processed_data, start_data, end_data
 
+class TimeWindowIndex:
+    """
+    Events sorted once by (time_window, bike_type) with offset arrays into the sorted frame,
+    so the rows of one window, optionally of one bike type, are a contiguous slice that
+    costs O(window size) to take and shares memory with the sorted frame.
+    """
+
+    def __init__(self, data, n_windows=144):
+        bike_codes, bike_types = pd.factorize(data['bike_type'], sort=True, use_na_sentinel=False)
+        time_windows = data['time_window'].to_numpy()
+        order = np.lexsort((bike_codes, time_windows))
+        self.data = data.take(order)
+        self.bike_types = list(bike_types)
+        self.n_windows = n_windows
+
+        bucket_keys = time_windows[order].astype('int64') * len(self.bike_types) + bike_codes[order]
+        self.offsets = np.searchsorted(bucket_keys, np.arange(n_windows * len(self.bike_types) + 1))
+
+    def window(self, time_window, bike_type='all'):
+        bike_type_count = len(self.bike_types)
+        if bike_type == 'all':
+            start = self.offsets[time_window * bike_type_count]
+            end = self.offsets[(time_window + 1) * bike_type_count]
+        elif bike_type in self.bike_types:
+            bucket = time_window * bike_type_count + self.bike_types.index(bike_type)
+            start, end = self.offsets[bucket], self.offsets[bucket + 1]
+        else:
+            start = end = 0
+        return self.data.iloc[start:end]
+
+class WindowGroupCounts:
+    """
+    Event counts per (bike_type, time_window, coordinate_group_id) as one dense array,
+    computed once, so a window's map layer is just the groups with events in it and their
+    counts rather than every raw event.
+    """
+
+    def __init__(self, data, n_windows=144):
+        bike_codes, bike_types = pd.factorize(data['bike_type'], sort=True, use_na_sentinel=False)
+        group_ids = data['coordinate_group_id'].to_numpy()
+        n_groups = int(group_ids.max()) + 1 if len(data) else 0
+        self.bike_types = list(bike_types)
+        self.n_windows = n_windows
+
+        flat_keys = (bike_codes * n_windows + data['time_window'].to_numpy()) * n_groups + group_ids
+        self.counts = (np.bincount(flat_keys, minlength=len(self.bike_types) * n_windows * n_groups)
+                       .astype('uint32')
+                       .reshape(len(self.bike_types), n_windows, n_groups))
+        self.all_bike_counts = self.counts.sum(axis=0, dtype='uint32')
+
+        self.group_lat = np.full(n_groups, np.nan, dtype=data['group_lat'].dtype)
+        self.group_lng = np.full(n_groups, np.nan, dtype=data['group_lng'].dtype)
+        self.group_lat[group_ids] = data['group_lat'].to_numpy()
+        self.group_lng[group_ids] = data['group_lng'].to_numpy()
+
+    @classmethod
+    def from_counts(cls, counts, bike_types, group_lat, group_lng):
+        # Counts already aggregated elsewhere (e.g. an ActivityCube), in the same layout
+        window_group_counts = cls.__new__(cls)
+        window_group_counts.bike_types = list(bike_types)
+        window_group_counts.n_windows = counts.shape[1]
+        window_group_counts.counts = counts
+        window_group_counts.all_bike_counts = counts.sum(axis=0, dtype='uint32')
+        window_group_counts.group_lat = np.asarray(group_lat)
+        window_group_counts.group_lng = np.asarray(group_lng)
+        return window_group_counts
+
+    def bike_type_counts(self, bike_type='all'):
+        # (n_windows, n_groups) counts for one bike type, or summed over all of them
+        if bike_type == 'all':
+            return self.all_bike_counts
+        if bike_type in self.bike_types:
+            return self.counts[self.bike_types.index(bike_type)]
+        return np.zeros(self.counts.shape[1:], dtype='uint32')
+
+    def max_group_count(self, bike_type='all'):
+        counts = self.bike_type_counts(bike_type)
+        return int(counts.max()) if counts.size else 0
+
+    def window_points(self, time_window, bike_type='all'):
+        window_counts = self.bike_type_counts(bike_type)[time_window]
+        groups = np.flatnonzero(window_counts)
+        return pd.DataFrame({
+            'coordinate_group_id': groups,
+            'group_lng': self.group_lng[groups],
+            'group_lat': self.group_lat[groups],
+            'count': window_counts[groups],
+        })
+
+class LazyTimeWindowSource:
+    """
+    Events of one type, read from Parquet a window at a time with the same `window()` call
+    as TimeWindowIndex. Only DASHBOARD_EVENT_COLUMNS are read and the event type, window,
+    bike type and date filters are pushed down to the scan, so with files written by
+    save_events_by_time_window a window costs only its own row groups, however many days
+    or events the file holds.
+    """
+
+    def __init__(self, events_parquet_path, event_type, date=None, columns=DASHBOARD_EVENT_COLUMNS):
+        self.dataset = ds.dataset(events_parquet_path, format='parquet', partitioning='hive')
+        missing_columns = [col for col in columns if col not in self.dataset.schema.names]
+        if missing_columns:
+            raise ValueError(f"Missing required columns: {missing_columns}")
+        self.event_type = event_type
+        self.columns = columns
+        self.base_filter = ds.field('event_type') == event_type
+        if date is not None:
+            self.base_filter &= _date_range_filter(self.dataset, date, date, 'event_time', 'event_date')
+        stats = read_event_window_stats(events_parquet_path) if date is None else None
+        self.stats = stats[event_type] if stats else None
+        self._bike_types = None
+        # Files with window stats hold one (time_window, event_type) per row group, so a
+        # window's row groups can be looked up from the footer statistics once
+        self._parquet_file = None
+        self._window_row_groups = None
+        if self.stats is not None:
+            self._parquet_file = pq.ParquetFile(events_parquet_path)
+            self._window_row_groups = self._index_window_row_groups()
+            self._read_lock = threading.Lock()
+
+    def _index_window_row_groups(self):
+        metadata = self._parquet_file.metadata
+        schema = self._parquet_file.schema_arrow
+        time_window_column = schema.get_field_index('time_window')
+        event_type_column = schema.get_field_index('event_type')
+        window_row_groups = {}
+        for row_group in range(metadata.num_row_groups):
+            columns = metadata.row_group(row_group)
+            if columns.column(event_type_column).statistics.min == self.event_type:
+                time_window = columns.column(time_window_column).statistics.min
+                window_row_groups.setdefault(time_window, []).append(row_group)
+        return window_row_groups
+
+    @property
+    def bike_types(self):
+        if self._bike_types is None:
+            if self.stats is not None:
+                self._bike_types = self.stats['bike_types']
+            else:
+                bike_types = self.dataset.to_table(columns=['bike_type'], filter=self.base_filter)['bike_type']
+                self._bike_types = sorted(bike_types.unique().to_pylist())
+        return self._bike_types
+
+    def __len__(self):
+        if self.stats is not None:
+            return self.stats['events']
+        return self.dataset.count_rows(filter=self.base_filter)
+
+    def read(self, filter=None, columns=None):
+        scan_filter = self.base_filter if filter is None else self.base_filter & filter
+        return self.dataset.to_table(columns=columns or self.columns, filter=scan_filter).to_pandas()
+
+    def window(self, time_window, bike_type='all'):
+        if self._window_row_groups is not None:
+            with self._read_lock:
+                table = self._parquet_file.read_row_groups(self._window_row_groups.get(time_window, []), columns=self.columns)
+            if bike_type != 'all':
+                table = table.filter(pc.equal(table['bike_type'], bike_type))
+            return table.to_pandas()
+        window_filter = ds.field('time_window') == time_window
+        if bike_type != 'all':
+            window_filter &= ds.field('bike_type') == bike_type
+        return self.read(window_filter)
+
+class LazyWindowGroupCounts:
+    """WindowGroupCounts for a LazyTimeWindowSource, counting each window's groups when it is read."""
+
+    def __init__(self, source):
+        self.source = source
+        self._max_group_counts = dict(source.stats['max_group_count']) if source.stats and 'max_group_count' in source.stats else None
+
+    @property
+    def bike_types(self):
+        return self.source.bike_types
+
+    def max_group_count(self, bike_type='all'):
+        if self._max_group_counts is None:
+            # No stats in the file: one pass over the few columns they are computed from
+            events = self.source.read(columns=['event_type', 'bike_type', 'time_window', 'coordinate_group_id'])
+            self._max_group_counts = event_window_stats(events)[self.source.event_type]['max_group_count']
+        return self._max_group_counts.get(bike_type, 0)
+
+    def window_points(self, time_window, bike_type='all'):
+        events = self.source.window(time_window, bike_type)
+        group_ids = events['coordinate_group_id'].to_numpy()
+        window_counts = np.bincount(group_ids).astype('uint32') if len(events) else np.zeros(0, dtype='uint32')
+        groups = np.flatnonzero(window_counts)
+        group_lat = np.empty(len(window_counts), dtype=events['group_lat'].dtype)
+        group_lng = np.empty(len(window_counts), dtype=events['group_lng'].dtype)
+        group_lat[group_ids] = events['group_lat'].to_numpy()
+        group_lng[group_ids] = events['group_lng'].to_numpy()
+        return pd.DataFrame({
+            'coordinate_group_id': groups,
+            'group_lng': group_lng[groups],
+            'group_lat': group_lat[groups],
+            'count': window_counts[groups],
+        })
+
+_dataset_tokens = itertools.count()
+
+class VisualizationDataset:
+    """
+    Start/end events with their window index and group counts, prepared once and treated
+    as read-only so a single copy can back every dashboard session in the process.
+    """
+
+    @instrumented('data_loader.prepare_visualization_dataset')
+    def __init__(self, start_data, end_data, n_windows=144):
+        # Identifies this dataset in caches of things derived from it (e.g. rendered frames)
+        self.cache_token = next(_dataset_tokens)
+        self.start_data = start_data
+        self.end_data = end_data
+        self.start_index = TimeWindowIndex(start_data, n_windows)
+        self.end_index = TimeWindowIndex(end_data, n_windows)
+        self.start_counts = WindowGroupCounts(start_data, n_windows)
+        self.end_counts = WindowGroupCounts(end_data, n_windows)
+        for array in (self.start_index.offsets, self.end_index.offsets,
+                      self.start_counts.counts, self.start_counts.all_bike_counts,
+                      self.end_counts.counts, self.end_counts.all_bike_counts):
+            array.flags.writeable = False
+
+    @property
+    def is_empty(self):
+        return len(self.start_data) == 0 or len(self.end_data) == 0
+
+class LazyVisualizationDataset:
+    """
+    VisualizationDataset that reads each window from Parquet when it is first needed,
+    so opening it reads only the file footer (and, for files without window stats,
+    the few columns the elevation scale is computed from). `start_data` and `end_data`
+    are None. Given an ActivityCube built from the same events, the group counts come
+    from the cube instead, so aggregated windows never read the events at all.
+    """
+
+    def __init__(self, events_parquet_path, date=None, activity_cube=None):
+        self.cache_token = next(_dataset_tokens)
+        self.start_data = None
+        self.end_data = None
+        self.start_index = LazyTimeWindowSource(events_parquet_path, 'start', date)
+        self.end_index = LazyTimeWindowSource(events_parquet_path, 'end', date)
+        if activity_cube is not None:
+            self.start_counts, self.end_counts = (
+                WindowGroupCounts.from_counts(activity_cube.window_group_counts(event_type, date, date), activity_cube.bike_types,
+                                              activity_cube.group_lat, activity_cube.group_lng)
+                for event_type in EVENT_TYPES
+            )
+        else:
+            self.start_counts = LazyWindowGroupCounts(self.start_index)
+            self.end_counts = LazyWindowGroupCounts(self.end_index)
+
+    @property
+    def is_empty(self):
+        return len(self.start_index) == 0 or len(self.end_index) == 0
+
+_shared_datasets = {}
+_shared_datasets_lock = threading.Lock()
+
+def _latest_mtime_ns(parquet_path):
+    parquet_path = Path(parquet_path)
+    if parquet_path.is_dir():
+        return max((f.stat().st_mtime_ns for f in parquet_path.rglob('*.parquet')), default=0)
+    return parquet_path.stat().st_mtime_ns
+
+@instrumented()
+def load_shared_visualization_dataset(events_parquet_path, group_coordinates=True, distance_threshold_meters=30.0, date=None,
+                                      compact_schema=False, lazy=False, activity_cube=False):
+    """
+    Process-wide cache around load_and_prepare_visualization_data. Every caller with the
+    same arguments gets the same VisualizationDataset until the events file changes on
+    disk, at which point the next caller reloads it. With `lazy`, it is a
+    LazyVisualizationDataset, which needs events with grouped coordinates; with
+    `activity_cube` as well, its group counts come from the events' activity cube when
+    one is up to date.
+    """
+    source_mtime_ns = _latest_mtime_ns(events_parquet_path)
+    cube_sidecar_path = activity_cube_path(events_parquet_path) / 'cube.json'
+    if lazy and activity_cube and cube_sidecar_path.exists():
+        # A cube built after the dataset was cached replaces it too
+        source_mtime_ns = max(source_mtime_ns, cube_sidecar_path.stat().st_mtime_ns)
+    cache_key = (str(Path(events_parquet_path).resolve()), group_coordinates, distance_threshold_meters,
+                 None if date is None else pd.to_datetime(date).strftime('%Y-%m-%d'), compact_schema, lazy, activity_cube)
+    with _shared_datasets_lock:
+        cached = _shared_datasets.get(cache_key)
+        if cached is not None and cached[0] == source_mtime_ns:
+            return cached[1]
+        if lazy:
+            cube = load_activity_cube(events_parquet_path) if activity_cube else None
+            dataset = LazyVisualizationDataset(events_parquet_path, date, cube)
+        else:
+            _, start_data, end_data = load_and_prepare_visualization_data(
+                events_parquet_path, group_coordinates, distance_threshold_meters, date, compact_schema=compact_schema
+            )
+            dataset = VisualizationDataset(start_data, end_data)
+        _shared_datasets[cache_key] = (source_mtime_ns, dataset)
+        return dataset
+
+@instrumented()
 def filter_data_for_time_window(start_data, end_data, time_window, bike_type='all'):
+    if isinstance(start_data, (TimeWindowIndex, LazyTimeWindowSource)):
+        return start_data.window(time_window, bike_type), end_data.window(time_window, bike_type)
+
     start_filtered = start_data[start_data.time_window == time_window].copy()
     end_filtered = end_data[end_data.time_window == time_window].copy()
     
@@ -58,28 +515,33 @@ def filter_data_for_time_window(start_data, end_data, time_window, bike_type='al
     
     return start_filtered, end_filtered
 
+@instrumented()
 def standardize_numerical_columns(df, numerical_columns):
     scaler = StandardScaler()
     df[numerical_columns] = scaler.fit_transform(df[numerical_columns])
     return df
 
+@instrumented()
 def one_hot_encode_categorical_columns(df, categorical_columns):
     df = pd.get_dummies(df, columns=categorical_columns, drop_first=True)
     return df
 
-def preprocess_data(events_data, group_coordinates=True, distance_threshold_meters=30.0):
+# Dense in-memory features; src/event_features.py builds the same ones in batches as a sparse matrix
+@instrumented()
+def preprocess_data(events_data, group_coordinates=True, distance_threshold_meters=30.0, coordinate_index_path=None):
     processed_data = events_data.copy()
     
     if group_coordinates and 'group_lat' not in processed_data.columns:
-        processed_data = group_nearby_coordinates(processed_data, distance_threshold_meters)
+        processed_data = group_nearby_coordinates(processed_data, distance_threshold_meters, coordinate_index_path=coordinate_index_path)
     
     processed_data = standardize_numerical_columns(processed_data, ['lat', 'lng'])
     processed_data = one_hot_encode_categorical_columns(processed_data, ['event_type', 'bike_type', 'time_window'])
     
     return processed_data
 
-def load_and_preprocess_data(events_parquet_path, group_coordinates=True, distance_threshold_meters=30.0):
+@instrumented()
+def load_and_preprocess_data(events_parquet_path, group_coordinates=True, distance_threshold_meters=30.0, coordinate_index_path=None):
     events_data = pd.read_parquet(events_parquet_path)
-    processed_data = preprocess_data(events_data, group_coordinates, distance_threshold_meters)
+    processed_data = preprocess_data(events_data, group_coordinates, distance_threshold_meters, coordinate_index_path)
     
     return processed_data
@@ -1,60 +1,208 @@
+import argparse
+import json
 import pandas as pd
-import uuid
 import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from pathlib import Path
 import sys
 sys.path.append(str(Path(__file__).parent.parent))
-from src.data_loader import group_nearby_coordinates
+from src.data_loader import (EVENT_WINDOW_STATS_KEY, compact_event_columns, event_window_stats, group_nearby_coordinates,
+                             read_parquet_for_date, read_parquet_for_date_range)
+from src.activity_cube import build_activity_cube
+from src.instrumentation import enable_instrumentation, export_trace, instrumented, stage
 
-def process_clean_to_events(clean_parquet_path, output_parquet_path, group_coordinates=True, distance_threshold_meters=30.0):
-    busiest_day_df = pd.read_parquet(clean_parquet_path)
-    
-    events = pd.concat([
-        busiest_day_df.assign(
-            event_id  = [str(uuid.uuid4()) for _ in range(len(busiest_day_df))],
-            event_time= busiest_day_df["started_at"],
-            event_type= "start",
-            lat       = busiest_day_df["start_lat"],
-            lng       = busiest_day_df["start_lng"],
-            bike_type = busiest_day_df["rideable_type"],
-            ride_id   = busiest_day_df["ride_id"],
-        ),
-        busiest_day_df.assign(
-            event_id  = [str(uuid.uuid4()) for _ in range(len(busiest_day_df))],
-            event_time= busiest_day_df["ended_at"],
-            event_type= "end",
-            lat       = busiest_day_df["end_lat"],
-            lng       = busiest_day_df["end_lng"],
-            bike_type = busiest_day_df["rideable_type"],
-            ride_id   = busiest_day_df["ride_id"],
-        ),
-    ], ignore_index=True)
-
-    first_day = events['event_time'].dt.date.min()
-    events = events[events['event_time'].dt.date == first_day]
-
-    events["minute"] = events["event_time"].dt.hour * 60 + events["event_time"].dt.minute
-    events['time_window'] = events['minute'] // 10
+NANOSECONDS_PER_MINUTE = 60 * 1_000_000_000
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_TIME_WINDOW = 10
+
+@instrumented()
+def build_ride_events(rides):
+    """
+    Expand each ride into a start and an end event, building only the event columns.
+
+    Event IDs are deterministic int64s: twice the ride's position in `rides`, plus one
+    for the end event, so reruns over the same clean data produce the same IDs.
+    """
+    ride_count = len(rides)
+    ride_positions = np.arange(ride_count, dtype='int64')
+    return pd.DataFrame({
+        'event_id': np.concatenate([ride_positions * 2, ride_positions * 2 + 1]),
+        'ride_id': pd.concat([rides['ride_id'], rides['ride_id']], ignore_index=True),
+        'event_time': np.concatenate([rides['started_at'].to_numpy(), rides['ended_at'].to_numpy()]),
+        'event_type': np.repeat(np.array(['start', 'end'], dtype=object), ride_count),
+        'lat': np.concatenate([rides['start_lat'].to_numpy(), rides['end_lat'].to_numpy()]),
+        'lng': np.concatenate([rides['start_lng'].to_numpy(), rides['end_lng'].to_numpy()]),
+        'bike_type': pd.concat([rides['rideable_type'], rides['rideable_type']], ignore_index=True),
+    })
+
+@instrumented()
+def add_event_time_columns(events):
+    """
+    Add `minute` (0-1439) and `time_window` (0-143) from integer epoch arithmetic on
+    `event_time`, and return each event's day as days since the epoch.
+    """
+    epoch_minutes = events['event_time'].to_numpy(dtype='datetime64[ns]').view('int64') // NANOSECONDS_PER_MINUTE
+    minute_of_day = epoch_minutes % MINUTES_PER_DAY
+    events['minute'] = minute_of_day.astype('int32')
+    events['time_window'] = (minute_of_day // MINUTES_PER_TIME_WINDOW).astype('int32')
+    return epoch_minutes // MINUTES_PER_DAY
+
+@instrumented()
+def process_clean_to_events(clean_parquet_path, output_parquet_path, group_coordinates=True, distance_threshold_meters=30.0, date=None,
+                            coordinate_index_path=None, compact_schema=False, window_row_groups=False):
+    with stage('data_processor.read_clean_rides') as record:
+        if date is not None:
+            busiest_day_df = read_parquet_for_date(clean_parquet_path, date, 'started_at', 'ride_date')
+        else:
+            busiest_day_df = pd.read_parquet(clean_parquet_path)
+        record.rows_out = len(busiest_day_df)
+    if busiest_day_df.empty:
+        raise ValueError(f"No rides on {date} in {clean_parquet_path}" if date is not None else f"No rides in {clean_parquet_path}")
     
-    events = events.drop(columns=['rideable_type', 'started_at', 'ended_at', 'start_lat', 
-                                'start_lng', 'end_lat', 'end_lng', 'ride_date'], errors='ignore')
+    events = build_ride_events(busiest_day_df)
+
+    event_days = add_event_time_columns(events)
+    events = events[event_days == event_days.min()]
     
     if group_coordinates:
-        events = group_nearby_coordinates(events, distance_threshold_meters)
+        events = group_nearby_coordinates(events, distance_threshold_meters, coordinate_index_path=coordinate_index_path)
     
     columns = ['event_id'] + [col for col in events.columns if col != 'event_id']
     events = events[columns]
-    events = events.sort_values('event_time')
+    if compact_schema:
+        events = compact_event_columns(events)
+    with stage('data_processor.sort_events', rows_in=len(events)):
+        events = events.sort_values('event_time', kind='stable')
     
-    events.to_parquet(output_parquet_path, index=False, engine='pyarrow')
+    with stage('data_processor.write_events', rows_in=len(events)):
+        if window_row_groups:
+            save_events_by_time_window(events, output_parquet_path)
+        else:
+            events.to_parquet(output_parquet_path, index=False, engine='pyarrow')
+    return events
+
+@instrumented()
+def save_events_by_time_window(events, output_parquet_path, max_rows_per_group=64_000):
+    """
+    Write events ordered by time_window, then event_type, then event time, with row groups
+    that never span two (time_window, event_type) pairs, so a reader filtering on them
+    skips every other row group by its statistics. The per-type counts the dashboard
+    needs up front are stored in the file metadata (see event_window_stats).
+    """
+    type_codes = pd.factorize(events['event_type'], sort=True)[0]
+    time_windows = events['time_window'].to_numpy().astype('int64')
+    order = np.lexsort((type_codes, time_windows))
+    table = pa.Table.from_pandas(events.iloc[order], preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[EVENT_WINDOW_STATS_KEY] = json.dumps(event_window_stats(events)).encode()
+    table = table.replace_schema_metadata(metadata)
+
+    group_keys = time_windows[order] * (type_codes.max() + 1 if len(events) else 1) + type_codes[order]
+    group_starts = np.concatenate([[0], np.flatnonzero(np.diff(group_keys)) + 1])
+    group_ends = np.append(group_starts[1:], len(group_keys))
+    with pq.ParquetWriter(output_parquet_path, table.schema) as writer:
+        if len(events) == 0:
+            writer.write_table(table)
+        for group_start, group_end in zip(group_starts, group_ends):
+            writer.write_table(table.slice(group_start, group_end - group_start), row_group_size=max_rows_per_group)
+
+@instrumented()
+def save_events_to_partitioned_dataset(events, dataset_dir, max_rows_per_group=64_000):
+    # Only the days being written are replaced; other days already in the dataset are kept
+    event_dates = events['event_time'].to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').astype(str)
+    ds.write_dataset(
+        pa.Table.from_pandas(events.assign(event_date=event_dates), preserve_index=False),
+        dataset_dir,
+        format='parquet',
+        partitioning=['event_date'],
+        partitioning_flavor='hive',
+        existing_data_behavior='delete_matching',
+        max_rows_per_group=max_rows_per_group,
+        min_rows_per_group=min(max_rows_per_group, 8_192)
+    )
+
+@instrumented()
+def process_clean_to_daily_events(clean_parquet_path, output_dataset_dir, start_date, end_date, group_coordinates=True, distance_threshold_meters=30.0,
+                                  coordinate_index_path=None, compact_schema=False, window_row_groups=False):
+    """
+    Process every day from `start_date` to `end_date` (inclusive) in one pass.
+
+    Unlike process_clean_to_events, an event that happens after midnight is kept and
+    attributed to its own day, including the end events of rides started the day
+    before `start_date`. Events are written as a dataset partitioned by `event_date`,
+    with `minute` and `time_window` relative to each event's own day. Days already in
+    the dataset outside the range are left as they are.
+    """
+    range_start = pd.to_datetime(start_date).normalize()
+    range_end = pd.to_datetime(end_date).normalize()
+    # Rides last under 24 hours, so the day before the range holds every ride ending in it
+    rides = read_parquet_for_date_range(clean_parquet_path, range_start - pd.Timedelta(days=1), range_end, 'started_at', 'ride_date')
+
+    events = build_ride_events(rides)
+    event_days = add_event_time_columns(events)
+    first_day = range_start.to_datetime64().astype('datetime64[D]').astype('int64')
+    last_day = range_end.to_datetime64().astype('datetime64[D]').astype('int64')
+    events = events[(event_days >= first_day) & (event_days <= last_day)]
+    if events.empty:
+        raise ValueError(f"No rides from {range_start.date()} to {range_end.date()} in {clean_parquet_path}")
+
+    if group_coordinates:
+        events = group_nearby_coordinates(events, distance_threshold_meters, coordinate_index_path=coordinate_index_path)
+    if compact_schema:
+        events = compact_event_columns(events)
+
+    events = events.sort_values('event_time', kind='stable')
+    if window_row_groups:
+        # Each day's file is written in this order, so its row groups cover narrow window ranges
+        events = events.sort_values('time_window', kind='stable')
+    save_events_to_partitioned_dataset(events, output_dataset_dir)
     return events
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Turn cleaned rides into start/end events for the dashboard")
+    parser.add_argument('--date', help="Process this day (YYYY-MM-DD) from the partitioned rides dataset")
+    parser.add_argument('--start-date', help="Process every day from this one (YYYY-MM-DD) into a dataset partitioned by day")
+    parser.add_argument('--end-date', help="Last day processed with --start-date (defaults to --start-date)")
+    parser.add_argument('--compact-schema', action='store_true',
+                        help="Write categorical, small-integer and float32 columns and integer ride IDs")
+    parser.add_argument('--window-row-groups', action='store_true',
+                        help="Order events by time window so the dashboard can read one window at a time")
+    parser.add_argument('--activity-cube', action='store_true',
+                        help="Also precompute event counts per day, window, group and type next to the events")
+    parser.add_argument('--trace', type=Path, help="Record stage timings and write them to this JSON trace file")
+    parser.add_argument('--profile', action='store_true', help="With --trace, also write cProfile stats next to the trace")
+    parser.add_argument('--trace-memory', action='store_true', help="With --trace, also track allocations with tracemalloc")
+    args = parser.parse_args()
+    if args.trace:
+        enable_instrumentation(profile=args.profile, trace_memory=args.trace_memory)
+
     workspace_root = Path(__file__).resolve().parent.parent
-    clean_data_path = workspace_root / "data" / "clean" / "bluebikes_busiest_day.parquet"
+    if args.date or args.start_date:
+        clean_data_path = workspace_root / "data" / "clean" / "bluebikes_rides"
+    else:
+        clean_data_path = workspace_root / "data" / "clean" / "bluebikes_busiest_day.parquet"
     processed_data_path = workspace_root / "data" / "processed" / "bluebikes_events.parquet"
+    processed_dataset_path = workspace_root / "data" / "processed" / "bluebikes_events"
+    coordinate_index_path = workspace_root / "data" / "processed" / "coordinate_groups.parquet"
     
     if not clean_data_path.exists():
         raise FileNotFoundError(f"Clean data not found at {clean_data_path}")
     
-    process_clean_to_events(clean_data_path, processed_data_path, group_coordinates=True, distance_threshold_meters=30.0)
+    processed_data_path.parent.mkdir(parents=True, exist_ok=True)
+    events_output_path = processed_dataset_path if args.start_date else processed_data_path
+    if args.start_date:
+        process_clean_to_daily_events(clean_data_path, processed_dataset_path, args.start_date, args.end_date or args.start_date,
+                                      group_coordinates=True, distance_threshold_meters=30.0, coordinate_index_path=coordinate_index_path,
+                                      compact_schema=args.compact_schema, window_row_groups=args.window_row_groups)
+    else:
+        process_clean_to_events(clean_data_path, processed_data_path, group_coordinates=True, distance_threshold_meters=30.0, date=args.date,
+                                coordinate_index_path=coordinate_index_path, compact_schema=args.compact_schema,
+                                window_row_groups=args.window_row_groups)
+    if args.activity_cube:
+        cube = build_activity_cube(events_output_path)
+        print(f"Activity cube for {cube.day_count} day(s) and {cube.group_count} groups written to {cube.cube_dir}")
+
+    if args.trace:
+        print(f"Stage trace written to {export_trace(args.trace)}")
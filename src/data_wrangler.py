@@ -1,12 +1,169 @@
+import argparse
+import hashlib
+import os
+import shutil
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyarrow import csv as pa_csv
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
+from typing import Iterable, Iterator
+import sys
+sys.path.append(str(Path(__file__).parent.parent))
+from src.instrumentation import enable_instrumentation, export_trace, instrumented
 
-def load_monthly_data(data_dir_path: Path) -> pd.DataFrame:
-    csv_files = list(data_dir_path.glob('*.csv'))
+RIDE_COLUMN_DTYPES = {
+    'ride_id': 'string',
+    'rideable_type': 'string',
+    'start_lat': 'float64',
+    'start_lng': 'float64',
+    'end_lat': 'float64',
+    'end_lng': 'float64'
+}
+RIDE_TIMESTAMP_COLUMNS = ['started_at', 'ended_at']
+RIDE_COLUMNS = ['ride_id', 'rideable_type', 'started_at', 'ended_at', 'start_lat', 'start_lng', 'end_lat', 'end_lng']
+
+PYARROW_RIDE_COLUMN_TYPES = {
+    'ride_id': pa.string(),
+    'rideable_type': pa.string(),
+    'started_at': pa.timestamp('ns'),
+    'ended_at': pa.timestamp('ns'),
+    'start_lat': pa.float64(),
+    'start_lng': pa.float64(),
+    'end_lat': pa.float64(),
+    'end_lng': pa.float64()
+}
+
+def find_monthly_csv_files(data_dir_path: Path) -> list[Path]:
+    csv_files = sorted(data_dir_path.glob('*.csv'))
     if not csv_files:
         raise FileNotFoundError(f"No CSV files found in {data_dir_path}")
+    return csv_files
+
+@instrumented()
+def read_rides_csv(csv_file_path: Path | str, chunksize: int | None = None, engine: str = 'pandas'):
+    # Only the columns kept by preprocess_rides_data are parsed, already typed
+    if engine == 'pyarrow':
+        if chunksize is not None:
+            raise ValueError("chunksize is not supported by the pyarrow engine")
+        table = pa_csv.read_csv(
+            csv_file_path,
+            read_options=pa_csv.ReadOptions(use_threads=True),
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=RIDE_COLUMNS,
+                column_types=PYARROW_RIDE_COLUMN_TYPES
+            )
+        )
+        return table.to_pandas()
+    if engine != 'pandas':
+        raise ValueError(f"Unknown CSV engine: {engine}")
+    return pd.read_csv(
+        csv_file_path,
+        usecols=RIDE_COLUMNS,
+        dtype=RIDE_COLUMN_DTYPES,
+        parse_dates=RIDE_TIMESTAMP_COLUMNS,
+        date_format='ISO8601',
+        chunksize=chunksize
+    )
+
+def cached_parquet_path(csv_file_path: Path, cache_dir: Path) -> Path:
+    # The fingerprint changes whenever the CSV is replaced, resized or touched
+    stat = csv_file_path.stat()
+    fingerprint_key = f"{csv_file_path.resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+    fingerprint = hashlib.sha1(fingerprint_key.encode()).hexdigest()[:16]
+    return cache_dir / f"{csv_file_path.stem}-{fingerprint}.parquet"
+
+@instrumented()
+def convert_csv_to_cached_parquet(csv_file_path: Path, cache_dir: Path, engine: str = 'pandas') -> Path:
+    parquet_path = cached_parquet_path(csv_file_path, cache_dir)
+    if parquet_path.exists():
+        return parquet_path
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    for stale_path in cache_dir.glob(f"{csv_file_path.stem}-{'?' * 16}.parquet"):
+        stale_path.unlink(missing_ok=True)
+
+    rides = read_rides_csv(csv_file_path, engine=engine)
+    # Write to a temporary name first so concurrent or interrupted runs never see a partial file
+    temp_path = parquet_path.with_suffix(f".{os.getpid()}.tmp")
+    rides.to_parquet(temp_path, index=False, engine='pyarrow', compression='zstd')
+    os.replace(temp_path, parquet_path)
+    return parquet_path
+
+def read_rides_cached(csv_file_path: Path, cache_dir: Path, chunksize: int | None = None, engine: str = 'pandas'):
+    parquet_path = convert_csv_to_cached_parquet(csv_file_path, cache_dir, engine)
+    if chunksize is None:
+        return pd.read_parquet(parquet_path)
+    return (batch.to_pandas() for batch in pq.ParquetFile(parquet_path).iter_batches(batch_size=chunksize))
+
+@instrumented()
+def load_monthly_data(data_dir_path: Path, cache_dir: Path | None = None) -> pd.DataFrame:
+    csv_files = find_monthly_csv_files(data_dir_path)
+    if cache_dir is not None:
+        return pd.concat((read_rides_cached(f, cache_dir) for f in csv_files), ignore_index=True)
     return pd.concat((pd.read_csv(f) for f in csv_files), ignore_index=True)
 
+def iter_monthly_data(data_dir_path: Path, chunksize: int | None = None, cache_dir: Path | None = None) -> Iterator[pd.DataFrame]:
+    for csv_file in find_monthly_csv_files(data_dir_path):
+        if cache_dir is not None:
+            rides = read_rides_cached(csv_file, cache_dir, chunksize)
+            if chunksize is None:
+                yield rides
+            else:
+                yield from rides
+        elif chunksize is None:
+            yield read_rides_csv(csv_file)
+        else:
+            with read_rides_csv(csv_file, chunksize=chunksize) as reader:
+                yield from reader
+
+def iter_cleaned_rides(data_dir_path: Path, chunksize: int | None = None, cache_dir: Path | None = None) -> Iterator[pd.DataFrame]:
+    """
+    Stream the monthly files one file (or one chunk of `chunksize` rows) at a time,
+    yielding each part already typed and without outliers, so peak memory is
+    bounded by a single chunk rather than the whole year of raw rides.
+    """
+    for chunk in iter_monthly_data(data_dir_path, chunksize, cache_dir):
+        yield remove_ride_outliers(preprocess_rides_data(chunk))
+
+@instrumented()
+def load_cleaned_rides(data_dir_path: Path, chunksize: int | None = None, cache_dir: Path | None = None) -> pd.DataFrame:
+    return pd.concat(iter_cleaned_rides(data_dir_path, chunksize, cache_dir), ignore_index=True)
+
+def _load_and_clean_file(csv_file_path: Path, engine: str, cache_dir: Path | None) -> tuple[int, pd.DataFrame]:
+    if cache_dir is not None:
+        rides = read_rides_cached(csv_file_path, cache_dir, engine=engine)
+    else:
+        rides = read_rides_csv(csv_file_path, engine=engine)
+    return len(rides), remove_ride_outliers(preprocess_rides_data(rides))
+
+@instrumented()
+def load_cleaned_rides_parallel(data_dir_path: Path, max_workers: int | None = None, engine: str = 'pandas', cache_dir: Path | None = None) -> pd.DataFrame:
+    """
+    Parse, type-cast and filter each monthly file in its own worker process.
+
+    Files are merged in the same order as load_monthly_data and each file's index is
+    shifted by the raw row count of the files before it, so the result is identical
+    to remove_ride_outliers(preprocess_rides_data(load_monthly_data(data_dir_path))).
+    The pyarrow engine also parses each file with multiple threads. With a `cache_dir`,
+    files already converted to Parquet are read from the cache instead of re-parsed.
+    """
+    csv_files = find_monthly_csv_files(data_dir_path)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_load_and_clean_file, csv_files, repeat(engine), repeat(cache_dir)))
+
+    cleaned_parts = []
+    row_offset = 0
+    for raw_row_count, cleaned_part in results:
+        cleaned_part.index = cleaned_part.index + row_offset
+        row_offset += raw_row_count
+        cleaned_parts.append(cleaned_part)
+    return pd.concat(cleaned_parts)
+
+@instrumented()
 def preprocess_rides_data(df: pd.DataFrame) -> pd.DataFrame:
     df = df.drop(columns=['start_station_name', 'start_station_id', 'end_station_name', 'end_station_id', 'member_casual'], errors='ignore')
     df = df.astype({
@@ -19,9 +176,10 @@ def preprocess_rides_data(df: pd.DataFrame) -> pd.DataFrame:
         'end_lat': 'float64',
         'end_lng': 'float64'
     })
-    df['ride_date'] = pd.to_datetime(df['started_at'].dt.date)
+    df['ride_date'] = df['started_at'].dt.normalize()
     return df
 
+@instrumented()
 def remove_ride_outliers(df: pd.DataFrame) -> pd.DataFrame:
     ride_duration_seconds = (df['ended_at'] - df['started_at']).dt.total_seconds()
     return df[(ride_duration_seconds > 120) & (ride_duration_seconds < 86400)]
@@ -29,30 +187,134 @@ def remove_ride_outliers(df: pd.DataFrame) -> pd.DataFrame:
 def find_top_busiest_days(df: pd.DataFrame, top_n: int = 10) -> pd.Series:
     return df.groupby('ride_date').size().nlargest(top_n)
 
+def find_least_busy_days(df: pd.DataFrame, bottom_n: int = 10) -> pd.Series:
+    return df.groupby('ride_date').size().nsmallest(bottom_n)
+
+@instrumented()
+def count_rides_per_day(data_dir_path: Path, chunksize: int | None = None, cache_dir: Path | None = None) -> pd.Series:
+    # Running per-day totals, so only one cleaned chunk is ever held in memory
+    daily_ride_counts = pd.Series(dtype='int64')
+    for chunk in iter_cleaned_rides(data_dir_path, chunksize, cache_dir):
+        daily_ride_counts = daily_ride_counts.add(chunk['ride_date'].value_counts(), fill_value=0)
+    return daily_ride_counts.astype('int64').sort_index().rename_axis('ride_date')
+
+def build_daily_ride_table(daily_ride_counts: pd.Series) -> pd.DataFrame:
+    daily_ride_table = daily_ride_counts.rename('total_rides').reset_index()
+    daily_ride_table['busiest_rank'] = daily_ride_table['total_rides'].rank(method='min', ascending=False).astype('int64')
+    return daily_ride_table
+
 def get_rides_for_specific_date(df: pd.DataFrame, date_str: str) -> pd.DataFrame:
-    target_date = pd.to_datetime(date_str).date()
-    return df[df['ride_date'].dt.date == target_date]
+    target_date = pd.to_datetime(date_str).normalize()
+    return df[df['ride_date'] == target_date]
+
+@instrumented()
+def extract_rides_for_date(data_dir_path: Path, date_str: str, chunksize: int | None = None, cache_dir: Path | None = None) -> pd.DataFrame:
+    """
+    Second pass over the raw data that keeps only rides started on `date_str`.
+
+    The start-time range is pushed down into the cached Parquet reads (skipping row
+    groups by their statistics), or applied to each CSV chunk before any casting.
+    Rows come back in the same order as get_rides_for_specific_date on the full year.
+    """
+    day_start = pd.to_datetime(date_str).normalize()
+    day_end = day_start + pd.Timedelta(days=1)
+
+    def iter_rides_on_date():
+        for csv_file in find_monthly_csv_files(data_dir_path):
+            if cache_dir is not None:
+                parquet_path = convert_csv_to_cached_parquet(csv_file, cache_dir)
+                yield pd.read_parquet(parquet_path, filters=[('started_at', '>=', day_start), ('started_at', '<', day_end)])
+                continue
+            with read_rides_csv(csv_file, chunksize=chunksize or 1_000_000) as reader:
+                for chunk in reader:
+                    yield chunk[(chunk['started_at'] >= day_start) & (chunk['started_at'] < day_end)]
 
+    rides = pd.concat(iter_rides_on_date(), ignore_index=True)
+    return remove_ride_outliers(preprocess_rides_data(rides))
+
+@instrumented()
 def save_dataframe_to_parquet(df: pd.DataFrame, output_file_path: Path | str):
     df.to_parquet(output_file_path, index=False, engine='pyarrow')
 
+@instrumented()
+def save_rides_to_partitioned_dataset(rides: pd.DataFrame | Iterable[pd.DataFrame], dataset_dir: Path, partition_by: str = 'ride_date', max_rows_per_group: int = 64_000):
+    """
+    Write cleaned rides as a Hive-partitioned Parquet dataset, either one directory per
+    day (`ride_date=2024-09-17/`) or per month (`year=2024/month=9/`).
+
+    Accepts a single frame or a stream of cleaned chunks (e.g. iter_cleaned_rides), each
+    written as its own file per partition. Rows are sorted by `started_at` so row-group
+    statistics let readers skip straight to the requested time range.
+    """
+    if partition_by == 'ride_date':
+        partition_columns = ['ride_date']
+    elif partition_by == 'month':
+        partition_columns = ['year', 'month']
+    else:
+        raise ValueError(f"Unknown partitioning: {partition_by}")
+    if isinstance(rides, pd.DataFrame):
+        rides = [rides]
+
+    shutil.rmtree(dataset_dir, ignore_errors=True)
+    file_options = ds.ParquetFileFormat().make_write_options(compression='zstd')
+    for chunk_number, chunk in enumerate(rides):
+        chunk = chunk.sort_values('started_at', kind='stable')
+        if partition_by == 'ride_date':
+            chunk = chunk.assign(ride_date=chunk['ride_date'].values.astype('datetime64[D]').astype(str))
+        else:
+            chunk = chunk.assign(year=chunk['started_at'].dt.year, month=chunk['started_at'].dt.month)
+        ds.write_dataset(
+            pa.Table.from_pandas(chunk, preserve_index=False),
+            dataset_dir,
+            format='parquet',
+            partitioning=partition_columns,
+            partitioning_flavor='hive',
+            basename_template=f"part-{chunk_number}-{{i}}.parquet",
+            existing_data_behavior='overwrite_or_ignore',
+            file_options=file_options,
+            max_rows_per_group=max_rows_per_group,
+            min_rows_per_group=min(max_rows_per_group, 8_192)
+        )
+
 if __name__ == "__main__":
-    workspace_root = Path(__file__).resolve().parent
+    parser = argparse.ArgumentParser(description="Find the busiest day of rides in the raw Bluebikes CSVs")
+    parser.add_argument('--partition-by', choices=['ride_date', 'month'],
+                        help="Also write every cleaned ride as a partitioned Parquet dataset")
+    parser.add_argument('--trace', type=Path, help="Record stage timings and write them to this JSON trace file")
+    parser.add_argument('--profile', action='store_true', help="With --trace, also write cProfile stats next to the trace")
+    parser.add_argument('--trace-memory', action='store_true', help="With --trace, also track allocations with tracemalloc")
+    args = parser.parse_args()
+    if args.trace:
+        enable_instrumentation(profile=args.profile, trace_memory=args.trace_memory)
+
+    workspace_root = Path(__file__).resolve().parent.parent
     raw_data_directory = workspace_root / "data" / "raw"
     clean_data_directory = workspace_root / "data" / "clean"
+    cache_directory = workspace_root / "data" / "cache"
     output_parquet_filename = "bluebikes_busiest_day.parquet"
     output_parquet_path = clean_data_directory / output_parquet_filename
+    daily_counts_parquet_path = clean_data_directory / "bluebikes_daily_ride_counts.parquet"
+    rides_dataset_directory = clean_data_directory / "bluebikes_rides"
+
+    daily_ride_counts = count_rides_per_day(raw_data_directory, chunksize=1_000_000, cache_dir=cache_directory)
+    clean_data_directory.mkdir(parents=True, exist_ok=True)
+    save_dataframe_to_parquet(build_daily_ride_table(daily_ride_counts), daily_counts_parquet_path)
 
-    raw_df = load_monthly_data(raw_data_directory)
-    processed_df = preprocess_rides_data(raw_df)
-    cleaned_df = remove_ride_outliers(processed_df)
+    if args.partition_by:
+        save_rides_to_partitioned_dataset(
+            iter_cleaned_rides(raw_data_directory, cache_dir=cache_directory),
+            rides_dataset_directory,
+            partition_by=args.partition_by
+        )
     
-    top_busiest_days = find_top_busiest_days(cleaned_df)
+    top_busiest_days = daily_ride_counts.nlargest(10)
     
     if not top_busiest_days.empty:
         busiest_day_date_str = top_busiest_days.index[0].strftime('%Y-%m-%d')
-        busiest_day_rides_df = get_rides_for_specific_date(cleaned_df, busiest_day_date_str)
+        busiest_day_rides_df = extract_rides_for_date(raw_data_directory, busiest_day_date_str, cache_dir=cache_directory)
         
         if not busiest_day_rides_df.empty:
-            clean_data_directory.mkdir(parents=True, exist_ok=True)
-            save_dataframe_to_parquet(busiest_day_rides_df, output_parquet_path)
\ No newline at end of file
+            save_dataframe_to_parquet(busiest_day_rides_df, output_parquet_path)
+
+    if args.trace:
+        print(f"Stage trace written to {export_trace(args.trace)}")
@@ -0,0 +1,108 @@
+"""
+Batched model features for events: the scaled coordinates and one-hot event type, bike
+type and time window that preprocess_data produces, built without holding the events or
+a dense one-hot frame in memory.
+"""
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+from scipy import sparse
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+from src.instrumentation import instrumented
+
+NUMERICAL_FEATURE_COLUMNS = ['lat', 'lng']
+CATEGORICAL_FEATURE_COLUMNS = ['event_type', 'bike_type', 'time_window']
+# Every batch is encoded against the same categories, sorted as pd.get_dummies sorts them
+DEFAULT_FEATURE_CATEGORIES = {
+    'event_type': ['end', 'start'],
+    'bike_type': ['classic_bike', 'electric_bike'],
+    'time_window': list(range(144)),
+}
+
+def iter_event_batches(events_parquet_path, columns, batch_size=1_000_000):
+    # Reads a file or partitioned dataset a record batch at a time, only the given columns
+    dataset = ds.dataset(events_parquet_path, format='parquet', partitioning='hive')
+    for batch in dataset.to_batches(columns=columns, batch_size=batch_size):
+        if batch.num_rows:
+            yield batch.to_pandas()
+
+class EventFeaturePipeline:
+    """
+    Standardizes NUMERICAL_FEATURE_COLUMNS and one-hot encodes CATEGORICAL_FEATURE_COLUMNS
+    (dropping each column's first category, like preprocess_data) a batch at a time.
+
+    Scaling statistics are accumulated with StandardScaler.partial_fit, so fitting is one
+    pass over the batches. transform() returns a float32 CSR matrix holding only the
+    non-zero one-hot entries; transform_codes() returns the scaled coordinates and the
+    category codes instead, for models that embed categories themselves. A category
+    missing from `categories` raises rather than silently changing the feature layout.
+    """
+
+    def __init__(self, categories=None):
+        self.categories = {**DEFAULT_FEATURE_CATEGORIES, **(categories or {})}
+        self.scaler = StandardScaler()
+        self.encoder = OneHotEncoder(
+            categories=[self.categories[column] for column in CATEGORICAL_FEATURE_COLUMNS],
+            drop='first',
+            sparse_output=True,
+            dtype=np.float32,
+        )
+        # With fixed categories, fitting only records them
+        self.encoder.fit(pd.DataFrame({column: self.categories[column][:1] for column in CATEGORICAL_FEATURE_COLUMNS}))
+
+    def partial_fit(self, events):
+        self.scaler.partial_fit(events[NUMERICAL_FEATURE_COLUMNS].to_numpy(dtype='float64'))
+        return self
+
+    def fit_batches(self, batches):
+        for events in batches:
+            self.partial_fit(events)
+        return self
+
+    def feature_names(self):
+        return NUMERICAL_FEATURE_COLUMNS + list(self.encoder.get_feature_names_out(CATEGORICAL_FEATURE_COLUMNS))
+
+    def _scaled_numerical(self, events):
+        return self.scaler.transform(events[NUMERICAL_FEATURE_COLUMNS].to_numpy(dtype='float64')).astype('float32')
+
+    def _categorical_frame(self, events):
+        # Categoricals go to the encoder as plain values, which is what its categories hold
+        return pd.DataFrame({column: np.asarray(events[column]) for column in CATEGORICAL_FEATURE_COLUMNS})
+
+    def transform(self, events):
+        return sparse.hstack([
+            sparse.csr_matrix(self._scaled_numerical(events)),
+            self.encoder.transform(self._categorical_frame(events)),
+        ], format='csr')
+
+    def transform_codes(self, events):
+        """`(scaled coordinates, codes)`: float32 (n, 2) and int16 (n, 3) category positions."""
+        codes = np.column_stack([
+            pd.Categorical(events[column], categories=self.categories[column]).codes.astype('int16')
+            for column in CATEGORICAL_FEATURE_COLUMNS
+        ])
+        if (codes < 0).any():
+            raise ValueError("Events have categories missing from the pipeline's categories")
+        return self._scaled_numerical(events), codes
+
+    def transform_batches(self, batches):
+        for events in batches:
+            yield self.transform(events)
+
+@instrumented()
+def build_event_feature_matrix(events_parquet_path, batch_size=1_000_000, categories=None):
+    """
+    Fit an EventFeaturePipeline over the events at `events_parquet_path` and return it with
+    the CSR feature matrix of every event. Two passes over the file: one reading only the
+    coordinates to fit the scaler, one encoding each batch, so memory is the sparse
+    matrix plus one batch.
+    """
+    pipeline = EventFeaturePipeline(categories)
+    pipeline.fit_batches(iter_event_batches(events_parquet_path, NUMERICAL_FEATURE_COLUMNS, batch_size))
+    feature_batches = pipeline.transform_batches(
+        iter_event_batches(events_parquet_path, NUMERICAL_FEATURE_COLUMNS + CATEGORICAL_FEATURE_COLUMNS, batch_size)
+    )
+    matrices = list(feature_batches)
+    if not matrices:
+        return pipeline, sparse.csr_matrix((0, len(pipeline.feature_names())), dtype=np.float32)
+    return pipeline, sparse.vstack(matrices, format='csr')
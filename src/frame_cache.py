@@ -0,0 +1,46 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+class FrameCache:
+    """
+    Bounded LRU cache of prerendered animation frames, shared by every dashboard session
+    in the process. Frames are keyed by whatever identifies their content (dataset,
+    rendering options, bike type, time window), so sessions showing the same data reuse
+    each other's frames, and frames of datasets nobody views any more age out.
+    """
+
+    def __init__(self, max_frames=1024, warmup_workers=2):
+        self.max_frames = max_frames
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=warmup_workers, thread_name_prefix='frame-warmup')
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._frames
+
+    def get(self, key, render):
+        with self._lock:
+            if key in self._frames:
+                self._frames.move_to_end(key)
+                return self._frames[key]
+        # Rendered outside the lock; two threads racing on one key just render it twice
+        frame = render()
+        with self._lock:
+            self._frames[key] = frame
+            self._frames.move_to_end(key)
+            while len(self._frames) > self.max_frames:
+                self._frames.popitem(last=False)
+        return frame
+
+    def warm(self, keys, render_for_key):
+        # Render the missing frames on the warm-up threads, in the order given
+        return [self._executor.submit(self.get, key, lambda key=key: render_for_key(key))
+                for key in keys if key not in self]
+
+    def clear(self):
+        with self._lock:
+            self._frames.clear()
+
+frame_cache = FrameCache()
@@ -0,0 +1,225 @@
+"""
+Opt-in stage timing for the pipeline and the dashboard.
+
+Nothing is recorded until `enable_instrumentation()` is called (or the `BLUEBIKES_TRACE`
+environment variable is set, see `configure_from_environment`). Each named stage then
+records its wall time, rows in and out, and RSS change, nested under whichever stage was
+open when it started. The records can be exported as a Chrome trace-event JSON file,
+which opens in Perfetto or chrome://tracing and is easy to load elsewhere, and every
+finished stage is also logged as one JSON line at DEBUG level.
+"""
+import atexit
+import contextvars
+import cProfile
+import functools
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+_enabled = False
+_records = deque(maxlen=200_000)
+_stage_ids = itertools.count(1)
+_current_stage = contextvars.ContextVar('current_stage', default=None)
+_profiler = None
+_profiling = False
+_started_at = time.perf_counter()
+
+def current_rss_bytes():
+    """Resident set size of this process, or None where it can't be read (Windows)."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # No procfs (macOS): fall back to the lifetime peak, which ru_maxrss reports in bytes there
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def enable_instrumentation(profile=False, trace_memory=False, max_records=200_000):
+    """
+    Start recording stages. `profile` also runs cProfile on the calling thread and
+    `trace_memory` starts tracemalloc, adding traced-allocation deltas to every stage.
+    """
+    global _enabled, _records, _profiler, _profiling
+    if _records.maxlen != max_records:
+        _records = deque(_records, maxlen=max_records)
+    if profile and not _profiling:
+        # After a disable, the same profiler resumes, so export_trace covers every enabled period
+        if _profiler is None:
+            _profiler = cProfile.Profile()
+        _profiler.enable()
+        _profiling = True
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _enabled = True
+
+def disable_instrumentation():
+    global _enabled, _profiling
+    _enabled = False
+    if _profiling:
+        _profiler.disable()
+        _profiling = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+def instrumentation_enabled():
+    return _enabled
+
+def clear_records():
+    _records.clear()
+
+def records():
+    return list(_records)
+
+class StageRecord(dict):
+    """What a stage records; the body of a stage may set `rows_out` or other attributes on it."""
+
+    @property
+    def rows_out(self):
+        return self.get('rows_out')
+
+    @rows_out.setter
+    def rows_out(self, rows):
+        self['rows_out'] = int(rows)
+
+class _DisabledStageRecord(StageRecord):
+    def __setitem__(self, key, value):
+        pass
+
+_DISABLED_RECORD = _DisabledStageRecord()
+
+@contextmanager
+def stage(name, rows_in=None, **attributes):
+    """
+    Record the body as stage `name`, e.g.
+
+        with stage('data_processor.sort_events', rows_in=len(events)) as record:
+            events = events.sort_values('event_time')
+            record.rows_out = len(events)
+    """
+    if not _enabled:
+        yield _DISABLED_RECORD
+        return
+
+    record = StageRecord(name=name, id=next(_stage_ids), parent_id=_current_stage.get(),
+                         thread=threading.current_thread().name, **attributes)
+    if rows_in is not None:
+        record['rows_in'] = int(rows_in)
+    token = _current_stage.set(record['id'])
+    rss_before = current_rss_bytes()
+    traced_before = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+    started = time.perf_counter()
+    try:
+        yield record
+    except BaseException as error:
+        record['error'] = type(error).__name__
+        raise
+    finally:
+        finished = time.perf_counter()
+        _current_stage.reset(token)
+        record['start_seconds'] = round(started - _started_at, 6)
+        record['wall_seconds'] = round(finished - started, 6)
+        rss_after = current_rss_bytes()
+        if rss_before is not None and rss_after is not None:
+            record['rss_delta_mb'] = round((rss_after - rss_before) / 2**20, 3)
+        if traced_before is not None and tracemalloc.is_tracing():
+            record['traced_delta_mb'] = round((tracemalloc.get_traced_memory()[0] - traced_before) / 2**20, 3)
+        _records.append(dict(record))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps(record, default=str))
+
+def _row_count(value):
+    # Frames, series and arrays count their rows, a tuple result counts its first item,
+    # and anything else (paths, iterators) has no row count
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    if getattr(value, 'ndim', 0) >= 1:
+        return len(value)
+    return None
+
+def instrumented(name=None):
+    """
+    Decorator recording each call as a stage (named after the function by default), with
+    rows in taken from its first argument and rows out from its result when those are
+    frames or arrays.
+    """
+    def decorator(function):
+        # Named after the file rather than the module, which is __main__ when run as a script
+        stage_name = name or f"{Path(function.__code__.co_filename).stem}.{function.__qualname__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with stage(stage_name, rows_in=_row_count(args[0]) if args else None) as record:
+                result = function(*args, **kwargs)
+                rows_out = _row_count(result)
+                if rows_out is not None:
+                    record.rows_out = rows_out
+                return result
+        return wrapper
+    return decorator
+
+def export_trace(trace_path, top_allocations=25):
+    """
+    Write the recorded stages as Chrome trace-event JSON. With profiling on, the cProfile
+    stats are dumped next to it as `<trace>.prof`; with tracemalloc on, the largest
+    allocation sites are added to the trace metadata.
+    """
+    trace_path = Path(trace_path)
+    trace_path.parent.mkdir(parents=True, exist_ok=True)
+    thread_ids = {}
+    events = []
+    for record in records():
+        args = {key: value for key, value in record.items()
+                if key not in ('name', 'thread', 'start_seconds', 'wall_seconds')}
+        events.append({
+            'name': record['name'],
+            'cat': record['name'].split('.', 1)[0],
+            'ph': 'X',
+            'ts': round(record['start_seconds'] * 1e6, 1),
+            'dur': round(record['wall_seconds'] * 1e6, 1),
+            'pid': os.getpid(),
+            'tid': thread_ids.setdefault(record['thread'], len(thread_ids) + 1),
+            'args': args,
+        })
+    metadata = {'threads': {thread: tid for thread, tid in thread_ids.items()}}
+
+    if _profiler is not None:
+        profile_path = trace_path.with_suffix('.prof')
+        _profiler.create_stats()
+        _profiler.dump_stats(profile_path)
+        metadata['cprofile_stats'] = str(profile_path)
+    if tracemalloc.is_tracing():
+        metadata['top_allocations'] = [
+            {'location': str(statistic.traceback[0]), 'size_mb': round(statistic.size / 2**20, 3), 'count': statistic.count}
+            for statistic in tracemalloc.take_snapshot().statistics('lineno')[:top_allocations]
+        ]
+
+    trace_path.write_text(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms', 'metadata': metadata}, default=str))
+    return trace_path
+
+def configure_from_environment():
+    """
+    Enable instrumentation when `BLUEBIKES_TRACE` names a trace file, which is written when
+    the process exits. `BLUEBIKES_PROFILE` may list `cprofile` and/or `tracemalloc`.
+    Useful where there is no command line to pass flags through, as under `panel serve`.
+    """
+    trace_path = os.environ.get('BLUEBIKES_TRACE')
+    if not trace_path or _enabled:
+        return
+    profile_options = {option.strip() for option in os.environ.get('BLUEBIKES_PROFILE', '').split(',')}
+    enable_instrumentation(profile='cprofile' in profile_options, trace_memory='tracemalloc' in profile_options)
+    atexit.register(export_trace, trace_path)
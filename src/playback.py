@@ -0,0 +1,109 @@
+import asyncio
+import time
+from collections import deque
+
+class PlaybackScheduler:
+    """
+    Drives an animation loop of `frame_count` frames from an asyncio task instead of a
+    periodic callback, so a slow frame never blocks the event loop.
+
+    Each tick works out which frame is due from the wall-clock time since playback was
+    (re)anchored, prepares it with `prepare_frame(frame)` on an executor thread, and then
+    hands the result to `apply_frame(frame, prepared)` on the event loop. When preparing
+    or applying falls behind, the frames that are already late are skipped rather than
+    shown late, so playback keeps wall-clock time.
+    """
+
+    def __init__(self, prepare_frame, apply_frame, frame_count, fps=1.0, executor=None, fps_window_seconds=3.0):
+        self.prepare_frame = prepare_frame
+        self.apply_frame = apply_frame
+        self.frame_count = frame_count
+        self.executor = executor
+        self.fps_window_seconds = fps_window_seconds
+        self.frames_shown = 0
+        self.frames_skipped = 0
+        self._fps = float(fps)
+        self._task = None
+        self._anchor_time = None
+        self._anchor_frame = 0
+        self._last_due = 0
+        self._anchor_count = 0
+        self._shown_at = deque()
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    @property
+    def fps(self):
+        return self._fps
+
+    @fps.setter
+    def fps(self, fps):
+        # Re-anchor at the latest frame so a speed change doesn't jump the playhead. Only the
+        # rate changed, so a frame still being prepared is still the right one to show.
+        self._anchor(self._last_due, drop_in_flight=False)
+        self._fps = float(fps)
+
+    @property
+    def achieved_fps(self):
+        """Frames actually applied per second over the last `fps_window_seconds`."""
+        self._forget_old_frames(time.monotonic())
+        if len(self._shown_at) < 2:
+            return 0.0
+        return (len(self._shown_at) - 1) / (self._shown_at[-1] - self._shown_at[0])
+
+    def start(self, frame, loop=None):
+        if self.running:
+            return
+        loop = loop or asyncio.get_event_loop()
+        self._anchor(frame)
+        self._shown_at.clear()
+        self._task = loop.create_task(self._run())
+
+    def seek(self, frame):
+        # Continue from `frame`, e.g. after the user moved the playhead
+        self._anchor(frame)
+
+    def stop(self):
+        if self.running:
+            self._task.cancel()
+        self._task = None
+
+    def _anchor(self, frame, drop_in_flight=True):
+        self._anchor_time = time.monotonic()
+        self._anchor_frame = frame
+        self._last_due = frame
+        if drop_in_flight:
+            self._anchor_count += 1
+
+    def _due_frame(self, now):
+        return self._anchor_frame + int((now - self._anchor_time) * self._fps)
+
+    def _forget_old_frames(self, now):
+        while self._shown_at and now - self._shown_at[0] > self.fps_window_seconds:
+            self._shown_at.popleft()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            now = time.monotonic()
+            due = self._due_frame(now)
+            if due <= self._last_due:
+                next_due_time = self._anchor_time + (self._last_due + 1 - self._anchor_frame) / self._fps
+                await asyncio.sleep(max(0.0, next_due_time - now))
+                continue
+
+            self.frames_skipped += due - self._last_due - 1
+            self._last_due = due
+            frame = due % self.frame_count
+            anchor_count = self._anchor_count
+            prepared = await loop.run_in_executor(self.executor, self.prepare_frame, frame)
+            # Drop the frame if playback was re-anchored while it was being prepared
+            if anchor_count != self._anchor_count:
+                continue
+            self.apply_frame(frame, prepared)
+            self.frames_shown += 1
+            now = time.monotonic()
+            self._shown_at.append(now)
+            self._forget_old_frames(now)